@@ -11,6 +11,7 @@ from .commands import ready
 from .meeseeksbox.commands import (
     black_suggest,
     blackify,
+    cancel,
     debug,
     party,
     precommit,
@@ -120,6 +121,41 @@ def load_config_from_env():
     # config option to forward requests as-is to a test server.
     config["forward_staging_url"] = os.environ.get("FORWARD_STAGING_URL", "")
     print("saw config forward", config["forward_staging_url"])
+    # number of threads running cheap (api calls only) and heavy (git
+    # operations) commands in the background.
+    config["light_workers"] = int(os.environ.get("LIGHT_WORKERS", 4))
+    config["heavy_workers"] = int(os.environ.get("HEAVY_WORKERS", 1))
+    # how many heavy commands can run at once on a repository / installation.
+    config["repo_concurrency"] = int(os.environ.get("REPO_CONCURRENCY", 1))
+    config["installation_concurrency"] = int(os.environ.get("INSTALLATION_CONCURRENCY", 2))
+    # above that many pending heavy jobs, low priority commands are refused.
+    config["shed_threshold"] = int(os.environ.get("SHED_THRESHOLD", 10))
+    # journal of accepted jobs, to resume them after a restart.
+    config["job_store"] = os.environ.get("JOB_STORE", "meeseeksdev-jobs.sqlite")
+    # how long to let running jobs finish on shutdown.
+    config["drain_timeout"] = float(os.environ.get("DRAIN_TIMEOUT", 25))
+    # number of processes serving hooks and running jobs, they share JOB_STORE.
+    config["processes"] = int(os.environ.get("PROCESSES", 1))
+    # how long a job queued by one process can wait before another one runs it.
+    config["steal_after"] = float(os.environ.get("STEAL_AFTER", 10))
+    # webhook URLs of all the nodes sharing installations, this one included,
+    # and of this one. Unset to run a single node.
+    config["nodes"] = [n for n in os.environ.get("NODES", "").split(",") if n]
+    config["node_url"] = os.environ.get("NODE_URL", "")
+    # listen with SO_REUSEPORT, needed to restart without downtime on SIGHUP.
+    config["reuse_port"] = os.environ.get("REUSE_PORT", "") not in ("", "0")
+    # heavy commands run in worker processes, replaced after that many jobs
+    # or once they used that many MiB of memory.
+    config["worker_max_jobs"] = int(os.environ.get("WORKER_MAX_JOBS", 20))
+    config["worker_max_rss"] = int(os.environ.get("WORKER_MAX_RSS", 1024))
+    # connections kept open to GitHub, per credential.
+    config["http_pool_size"] = int(os.environ.get("HTTP_POOL_SIZE", 10))
+    # how many responses of GitHub to keep, to make conditional requests.
+    config["response_cache"] = int(os.environ.get("RESPONSE_CACHE", 1000))
+    # seconds after which the GitHub requests of a command fail.
+    config["job_deadline"] = float(os.environ.get("JOB_DEADLINE", 1800))
+    # how many webhook delivery IDs to remember, to ignore redeliveries.
+    config["delivery_cache"] = int(os.environ.get("DELIVERY_CACHE", 10000))
 
     # Despite their names, this are not __your__ account, but an account created
     # for some functionalities of mr-meeseeks. Indeed, github does not allow
@@ -175,12 +211,14 @@ def main():
         "say": say,
         "debug": debug,
         "party": party,
+        "cancel": cancel,
     }
     commands["help"] = help_make(commands)
     box = MeeseeksBox(commands=commands, config=config)
 
     signal.signal(signal.SIGTERM, box.sig_handler)
     signal.signal(signal.SIGINT, box.sig_handler)
+    signal.signal(signal.SIGHUP, box.restart_handler)
 
     box.start()
 
@@ -0,0 +1,131 @@
+"""
+Admission control in front of the job queue.
+
+Every command consumes a token from buckets per user, per repository and per
+cost class; a command is refused when one of them is empty. When the heavy
+lane is backed up, low priority commands are shed altogether so that workers
+and our GitHub API budget go to what matters.
+"""
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from .scopes import Cost
+from .utils import add_event
+
+if TYPE_CHECKING:
+    from .jobs import Job, JobQueue
+
+HOUR = 3600
+
+"""
+(tokens per hour, burst) for each bucket kind and cost class.
+"""
+Limits = Dict[str, Dict[str, Tuple[float, float]]]
+LIMITS: Limits = {
+    "user": {Cost.light.value: (60, 10), Cost.heavy.value: (10, 3)},
+    "repo": {Cost.light.value: (600, 60), Cost.heavy.value: (30, 10)},
+    "lane": {Cost.light.value: (3600, 120), Cost.heavy.value: (120, 20)},
+}
+
+"""
+Tell a given user at most once per hour that we refused to do something.
+"""
+NOTIFY_LIMIT = (1, 1)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate / HOUR
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def available(self) -> bool:
+        self._refill()
+        return self.tokens >= 1
+
+    def take(self) -> bool:
+        if not self.available():
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Admission:
+    """
+    Decide whether jobs get queued.
+
+    ``shed_threshold`` is the number of pending heavy jobs above which low
+    priority commands are refused.
+    """
+
+    def __init__(self, jobs: "JobQueue", shed_threshold: int = 10, limits: Limits = LIMITS):
+        self.jobs = jobs
+        self.shed_threshold = shed_threshold
+        self.limits = limits
+        self._buckets: Dict[tuple, TokenBucket] = {}
+        self._lock = threading.Lock()
+        self.counts = {"admitted": 0, "throttled": 0, "shed": 0}
+
+    def _bucket(self, kind: str, lane: str, key: object) -> Optional[TokenBucket]:
+        limit = self.limits.get(kind, {}).get(lane)
+        if not limit:
+            return None
+        if (kind, lane, key) not in self._buckets:
+            self._buckets[(kind, lane, key)] = TokenBucket(*limit)
+        return self._buckets[(kind, lane, key)]
+
+    def overloaded(self) -> bool:
+        heavy = self.jobs.stats()["lanes"].get(Cost.heavy.value, {})
+        return bool(heavy.get("pending", 0) > self.shed_threshold)
+
+    def admit(self, job: "Job", low_priority: bool = False) -> Optional[str]:
+        """
+        Return ``None`` if the job can be queued, or why it cannot.
+        """
+        if low_priority and self.overloaded():
+            reason = "shed"
+        else:
+            with self._lock:
+                buckets = [
+                    self._bucket("user", job.lane, job.user),
+                    self._bucket("repo", job.lane, job.repo),
+                    self._bucket("lane", job.lane, None),
+                ]
+                if all(b.available() for b in buckets if b):
+                    for b in buckets:
+                        if b:
+                            b.take()
+                    reason = None
+                else:
+                    reason = "throttled"
+        self.counts[reason or "admitted"] += 1
+        if reason:
+            add_event("admission", {reason: job.command, "user": job.user, "repo": job.repo})
+        return reason
+
+    def should_notify(self, user: str) -> bool:
+        """Whether to tell ``user`` that something was refused, without spamming them."""
+        with self._lock:
+            bucket = self._buckets.setdefault(("notify", None, user), TokenBucket(*NOTIFY_LIMIT))
+            return bucket.take()
+
+    @staticmethod
+    def message(user: str, refused: List[Tuple["Job", str]]) -> str:
+        shed = ", ".join(f"`{job.command}`" for job, reason in refused if reason == "shed")
+        throttled = ", ".join(f"`{job.command}`" for job, reason in refused if reason != "shed")
+        lines = [f"Sorry @{user},"]
+        if shed:
+            lines.append(f"I have a lot of work queued right now, so I'm not going to do {shed}.")
+        if throttled:
+            lines.append(
+                f"I've been asked to do a lot recently, so I'm not going to do {throttled} for now."
+            )
+        lines.append("Please try again a bit later.")
+        return " ".join(lines)
@@ -0,0 +1,207 @@
+"""
+State shared by the commands of a single comment.
+
+A comment can ask for several commands, say ``precommit`` and then
+``backport to 1.x``. They run as separate jobs, one after the other, but can
+reuse the same session, the PR data and the checkout of the repository rather
+than starting from scratch each time.
+
+What is needed to dispatch the commands, and what they often look up next, is
+gathered in a single GraphQL query (see :func:`load_details`). The REST calls
+are still made when it fails, for example if the query is not allowed.
+"""
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional
+
+import yaml
+
+from .scopes import Permission
+
+if TYPE_CHECKING:
+    from .utils import AsyncSession, Session
+
+red = "\033[0;31m"
+normal = "\033[0m"
+
+GRAPHQL_URL = "https://api.github.com/graphql"
+
+DETAILS_QUERY = """
+query($owner: String!, $name: String!, $number: Int!, $user: String!) {
+  repository(owner: $owner, name: $name) {
+    nameWithOwner
+    defaultBranchRef { name }
+    config: object(expression: "HEAD:.meeseeksdev.yml") { ... on Blob { text } }
+    collaborators(query: $user, first: 10) { edges { permission node { login } } }
+    issueOrPullRequest(number: $number) {
+      ... on PullRequest {
+        maintainerCanModify
+        headRepository { nameWithOwner }
+        headRepositoryOwner { login }
+      }
+    }
+  }
+}
+"""
+
+# same as the ``permission`` field of the REST API, which has no maintain nor triage.
+PERMISSIONS = {
+    "ADMIN": Permission.admin,
+    "MAINTAIN": Permission.write,
+    "WRITE": Permission.write,
+    "TRIAGE": Permission.read,
+    "READ": Permission.read,
+}
+
+
+class Details:
+    """
+    What the commands of a comment need to know about the repository and the PR.
+
+    ``permission`` is ``None`` when the commenter is not a collaborator we can
+    see, ``config`` is the parsed ``.meeseeksdev.yml``, empty if there is none.
+    PR fields are ``None`` for comments on issues.
+    """
+
+    def __init__(self, repository: str, default_branch: str, config: dict):
+        self.repository = repository
+        self.default_branch = default_branch
+        self.config = config
+        self.permission: Optional[Permission] = None
+        self.head_repo: Optional[str] = None
+        self.head_user: Optional[str] = None
+        self.maintainer_can_modify: Optional[bool] = None
+
+
+def load_details(session: "Session", org: str, repo: str, number: int, user: str) -> Details:
+    """Get the :class:`Details` of comment by ``user`` on ``org/repo#number``, in one request."""
+    response = session.ghrequest(
+        "POST",
+        GRAPHQL_URL,
+        json={
+            "query": DETAILS_QUERY,
+            "variables": {"owner": org, "name": repo, "number": number, "user": user},
+        },
+        endpoint="read",
+    )
+    result = response.json()
+    repository = (result.get("data") or {}).get("repository")
+    if not repository:
+        raise ValueError(f"GraphQL query failed: {result.get('errors')}")
+    blob = repository["config"]
+    details = Details(
+        repository["nameWithOwner"],
+        repository["defaultBranchRef"]["name"],
+        (yaml.safe_load(blob["text"]) or {}) if blob else {},
+    )
+    # listing collaborators needs more access than we may have, it is then null.
+    for edge in (repository["collaborators"] or {}).get("edges", []):
+        if edge["node"]["login"].lower() == user.lower():
+            details.permission = PERMISSIONS.get(edge["permission"])
+    pull_request = repository["issueOrPullRequest"]
+    if pull_request and "maintainerCanModify" in pull_request:
+        details.maintainer_can_modify = pull_request["maintainerCanModify"]
+        if pull_request["headRepository"]:
+            details.head_repo = pull_request["headRepository"]["nameWithOwner"]
+        if pull_request["headRepositoryOwner"]:
+            details.head_user = pull_request["headRepositoryOwner"]["login"]
+    return details
+
+
+class CommentContext:
+    """
+    ``checkout`` is the absolute path of the clone left by a previous command,
+    in a state where the next one can fetch and check out what it needs.
+    """
+
+    def __init__(self):
+        self.session: Optional["Session"] = None
+        self.checkout: Optional[str] = None
+        self._pulls: Dict[str, Any] = {}
+        self._repositories: Dict[str, dict] = {}
+        self._details: Optional[Details] = None
+        self._details_failed = False
+        self._lock = threading.Lock()
+
+    def get_session(self, factory: Callable[[], "Session"]) -> "Session":
+        """The session of the comment, created by ``factory()`` the first time."""
+        with self._lock:
+            if self.session is None:
+                self.session = factory()
+            return self.session
+
+    def pull_request(self, session: "Session", url: str) -> dict:
+        """Data of the PR at API ``url``, fetched only once."""
+        if url not in self._pulls:
+            self._pulls[url] = session.ghrequest("GET", url, json=None).json()
+        return self._pulls[url]  # type: ignore[no-any-return]
+
+    async def async_pull_request(self, session: "AsyncSession", url: str) -> dict:
+        """Same as :meth:`pull_request`, not blocking."""
+        if url not in self._pulls:
+            self._pulls[url] = (await session.ghrequest("GET", url)).json()
+        return self._pulls[url]  # type: ignore[no-any-return]
+
+    def commits(self, session: "Session", url: str) -> list:
+        """Commits of the PR at API ``url``, fetched only once."""
+        if url + "/commits" not in self._pulls:
+            self._pulls[url + "/commits"] = list(session.paginate(url + "/commits"))
+        return self._pulls[url + "/commits"]  # type: ignore[no-any-return]
+
+    def files(self, session: "Session", url: str) -> list:
+        """Files changed by the PR at API ``url``, fetched only once."""
+        if url + "/files" not in self._pulls:
+            self._pulls[url + "/files"] = list(session.paginate(url + "/files"))
+        return self._pulls[url + "/files"]  # type: ignore[no-any-return]
+
+    def repository(self, session: "Session", org: str, repo: str) -> dict:
+        """Data of the ``org/repo`` repository, fetched only once."""
+        url = f"https://api.github.com/repos/{org}/{repo}"
+        if url not in self._repositories:
+            self._repositories[url] = session.ghrequest("GET", url).json()
+        return self._repositories[url]
+
+    def details(self, session: "Session", payload: dict, user: str) -> Optional[Details]:
+        """
+        :class:`Details` of the comment in ``payload``, loaded only once.
+
+        ``None`` if they could not be loaded, the REST API has to be used instead.
+        """
+        if self._details is None and not self._details_failed:
+            org = payload["repository"]["owner"]["login"]
+            repo = payload["repository"]["name"]
+            number = payload.get("issue", payload).get("number")
+            try:
+                self._details = load_details(session, org, repo, number, user)
+            except Exception as e:
+                print(red + f"could not load details of {org}/{repo}#{number}: {e}" + normal)
+                self._details_failed = True
+        return self._details
+
+    def default_branch(self, session: "Session", org: str, repo: str) -> str:
+        """Default branch of ``org/repo``, from the details of the comment if loaded."""
+        if (
+            self._details is not None
+            and self._details.repository.lower() == f"{org}/{repo}".lower()
+        ):
+            return self._details.default_branch
+        default_branch: str = self.repository(session, org, repo)["default_branch"]
+        return default_branch
+
+    async def async_default_branch(self, session: "AsyncSession", org: str, repo: str) -> str:
+        """Same as :meth:`default_branch`, not blocking."""
+        url = f"https://api.github.com/repos/{org}/{repo}"
+        details = self._details
+        known = details is not None and details.repository.lower() == f"{org}/{repo}".lower()
+        if not known and url not in self._repositories:
+            self._repositories[url] = (await session.ghrequest("GET", url)).json()
+        return self.default_branch(session.session, org, repo)
+
+    def forget_pull_requests(self) -> None:
+        """PRs, their commits and files changed, for example because we pushed to them."""
+        self._pulls.clear()
+        self._details = None
+
+    def reusable(self, path: str) -> bool:
+        """Whether ``path`` is the checkout a previous command left for us."""
+        return self.checkout == os.path.abspath(path) and os.path.exists(path)
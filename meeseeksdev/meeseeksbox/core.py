@@ -1,21 +1,47 @@
+import asyncio
 import base64
 import hmac
 import inspect
 import json
+import os
 import re
+import signal
+import subprocess
+import sys
 import time
 from asyncio import Future
 from concurrent.futures import ThreadPoolExecutor as Pool
+from typing import Callable, Dict, List, Optional
 
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 import yaml
 from tornado.ioloop import IOLoop
 from yieldbreaker import YieldBreaker
 
-from .scopes import Permission
-from .utils import ACCEPT_HEADER_SYMMETRA, Authenticator, add_event, clear_caches
+from .admission import Admission
+from .context import CommentContext
+from .jobs import Job, JobQueue
+from .scopes import Cost, Permission
+from .sharding import Shards
+from .store import DeliveryIndex, JobStore
+from .utils import (
+    ACCEPT_HEADER_SYMMETRA,
+    TIMEOUTS,
+    AsyncSession,
+    Authenticator,
+    add_event,
+    budgets,
+    clear_caches,
+    responses,
+    set_deadline,
+    set_low_priority,
+    transports,
+)
+from .workers import WorkerPool
 
 green = "\033[0;32m"
 yellow = "\033[0;33m"
@@ -24,6 +50,24 @@ normal = "\033[0m"
 
 pool = Pool(6)
 
+"""
+Header set on hooks forwarded by the node that received them to the one that
+owns their installation, which then handles them whatever it thinks.
+"""
+FORWARDED_BY = "X-Meeseeks-Forwarded-By"
+
+"""
+Environment variable telling a process started by a supervised restart which
+process to stop once it is ready to take over.
+"""
+PREDECESSOR = "MEESEEKSDEV_PREDECESSOR"
+
+"""
+Environment variable telling a process it was started by the supervising one,
+and has to serve rather than supervise.
+"""
+GENERATION = "MEESEEKSDEV_GENERATION"
+
 
 class Config:
     botname = None
@@ -35,6 +79,24 @@ class Config:
     webhook_secret = None
     personal_account_name = None
     personal_account_token = None
+    light_workers = 4
+    heavy_workers = 1
+    repo_concurrency = 1
+    installation_concurrency = 2
+    shed_threshold = 10
+    job_store = ":memory:"
+    delivery_cache = 10000
+    processes = 1
+    steal_after = 10
+    node_url = ""
+    reuse_port = False
+    nodes: List[str] = []
+    drain_timeout = 25
+    worker_max_jobs = 20
+    worker_max_rss = 1024
+    http_pool_size = 10
+    response_cache = 1000
+    job_deadline = 1800
 
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
@@ -50,6 +112,34 @@ class Config:
         return self
 
 
+def forward(req, url, extra_headers=None):
+    """Send the hook ``req`` as-is to ``url``, return the response if any."""
+    try:
+        import requests
+
+        headers = {
+            k: req.headers[k]
+            for k in (
+                "content-type",
+                "User-Agent",
+                "X-GitHub-Delivery",
+                "X-GitHub-Event",
+                "X-Hub-Signature",
+            )
+            if k in req.headers
+        }
+        headers.update(extra_headers or {})
+        req = requests.Request("POST", url, headers=headers, data=req.body)
+        prepared = req.prepare()
+        s = transports.get("forward")
+        res = s.send(prepared, timeout=TIMEOUTS["forward"])  # type:ignore[attr-defined]
+        return res
+    except Exception:
+        import traceback
+
+        traceback.print_exc()
+
+
 def verify_signature(payload, signature, secret):
     """
     Make sure hooks are encoded correctly
@@ -72,6 +162,27 @@ class MainHandler(BaseHandler):
         self.finish("No")
 
 
+class MetricsHandler(BaseHandler):
+    def initialize(self, dispatcher):
+        self.dispatcher = dispatcher
+
+    def get(self):
+        shards = self.dispatcher.shards
+        self.success(
+            payload={
+                "jobs": self.dispatcher.jobs.stats(),
+                "admission": self.dispatcher.admission.counts,
+                "duplicate_deliveries": self.dispatcher.deliveries.duplicates,
+                "nodes": sorted(shards.alive) if shards else [],
+                "workers": self.dispatcher.workers.stats(),
+                "http": transports.stats(),
+                "responses": responses.stats(),
+                "rate": budgets.stats(),
+                "skipped_lookups": self.dispatcher.skipped_lookups,
+            }
+        )
+
+
 def _strip_extras(c):
     if c.startswith("please "):
         c = c[6:].lstrip()
@@ -107,44 +218,19 @@ def process_mentioning_comment(body: str, bot_re: re.Pattern) -> list:
 
 
 class WebHookHandler(MainHandler):
-    def initialize(self, actions, config, auth, *args, **kwargs):
-        self.actions = actions
+    def initialize(self, config, dispatcher, *args, **kwargs):
         self.config = config
-        self.auth = auth
+        self.dispatcher = dispatcher
         super().initialize(*args, **kwargs)
 
     def get(self):
         self.finish("Webhook alive and listening")
 
     def post(self):
-        if self.config.forward_staging_url:
+        # Hooks forwarded by another node were already sent to staging there.
+        if self.config.forward_staging_url and FORWARDED_BY not in self.request.headers:
             try:
-
-                def fn(req, url):
-                    try:
-                        import requests
-
-                        headers = {
-                            k: req.headers[k]
-                            for k in (
-                                "content-type",
-                                "User-Agent",
-                                "X-GitHub-Delivery",
-                                "X-GitHub-Event",
-                                "X-Hub-Signature",
-                            )
-                        }
-                        req = requests.Request("POST", url, headers=headers, data=req.body)
-                        prepared = req.prepare()
-                        with requests.Session() as s:
-                            res = s.send(prepared)  # type:ignore[attr-defined]
-                        return res
-                    except Exception:
-                        import traceback
-
-                        traceback.print_exc()
-
-                pool.submit(fn, self.request, self.config.forward_staging_url)
+                pool.submit(forward, self.request, self.config.forward_staging_url)
             except Exception:
                 print(red + "failure to forward")
                 import traceback
@@ -163,6 +249,48 @@ class WebHookHandler(MainHandler):
             return self.error("Cannot validate GitHub payload with provided WebHook secret")
 
         payload = tornado.escape.json_decode(self.request.body)
+        return self.route(payload)
+
+    def route(self, payload):
+        """Handle the hook, or forward it to the node owning its installation."""
+        shards = self.dispatcher.shards
+        installation = payload.get("installation", {}).get("id")
+        if shards and installation and FORWARDED_BY not in self.request.headers:
+            owner = shards.owner(installation)
+            if owner != shards.me:
+                return self.forward_to(owner, payload)
+        return self.handle(payload)
+
+    async def forward_to(self, node: str, payload: dict) -> None:
+        print(green + f"forwarding hook for installation to {node}" + normal)
+        res = await IOLoop.current().run_in_executor(
+            pool, forward, self.request, node, {FORWARDED_BY: self.dispatcher.shards.me}
+        )
+        if res is not None and res.status_code < 500:
+            self.set_status(res.status_code)
+            await self.finish(res.content)
+            return
+        print(red + f"failed to forward hook to {node}" + normal)
+        self.dispatcher.shards.set_alive(node, False)
+        result = self.route(payload)
+        if result is not None:
+            await result
+
+    def handle(self, payload):
+        # GitHub redelivers hooks it thinks timed out, we may already be on it.
+        delivery = self.request.headers.get("X-GitHub-Delivery")
+        if self.dispatcher.deliveries.seen(delivery):
+            add_event("post", {"duplicate_delivery": delivery})
+            print(yellow + f"delivery {delivery} was already received, ignoring" + normal)
+            return self.finish("Delivery already received.")
+        try:
+            return self.handle_payload(payload)
+        except Exception:
+            # let GitHub redeliver it, as we do while shutting down.
+            self.dispatcher.deliveries.forget(delivery)
+            raise
+
+    def handle_payload(self, payload):
         org = payload.get("repository", {}).get("owner", {}).get("login")
         if not org:
             org = payload.get("issue", {}).get("repository", {}).get("owner", {}).get("login")
@@ -231,8 +359,7 @@ class WebHookHandler(MainHandler):
 
     @property
     def mention_bot_re(self):
-        botname = self.config.botname
-        return re.compile("@?" + re.escape(botname) + r"(?:\[bot\])?", re.IGNORECASE)
+        return self.dispatcher.mention_bot_re
 
     def dispatch_action(self, type_: str, payload: dict) -> Future:
         botname = self.config.botname
@@ -254,7 +381,7 @@ class WebHookHandler(MainHandler):
             installation = payload.get("installation", None)
             if installation and installation.get("account"):
                 print(f"({repo}) we got a new installation.")
-                self.auth._build_auth_id_mapping()
+                self.queue(Job("installation", payload))
                 return self.finish()
             else:
                 pass
@@ -295,7 +422,8 @@ class WebHookHandler(MainHandler):
                     return self.finish("Not responding to another bot")
                 body = payload["comment"]["body"]
                 if self.mention_bot_re.findall(body) or ("!msbox" in body):
-                    self.dispatch_on_mention(body, payload, user)
+                    for job in self.dispatcher.dispatch_on_mention(body, payload, user):
+                        self.queue(job)
                 else:
                     pass
                     # import textwrap
@@ -305,13 +433,20 @@ class WebHookHandler(MainHandler):
                     #       user, 'on', f'{what}/{number}')
             elif installation and installation.get("account"):
                 print(f"({repo}) we got a new installation.")
-                self.auth._build_auth_id_mapping()
+                self.queue(Job("installation", payload))
                 return self.finish()
             else:
                 print("not handled", payload)
         elif type_ == "submitted":
             # print(f'({repo}) ignoring `submitted`')
             pass
+        elif type_ == "synchronize":
+            # new commits on a PR, jobs working on the previous ones are stale.
+            pull_request = payload.get("pull_request", {})
+            if pull_request:
+                superseded = self.dispatcher.supersede(payload)
+                if superseded:
+                    add_event("superseded", {"count": len(superseded)})
         else:
             if type_ == "closed":
                 is_pr = payload.get("pull_request", {})
@@ -328,56 +463,7 @@ class WebHookHandler(MainHandler):
                         + f"(https://github.com/{repo}/pull/{num}) merged (action: {action}, merged:{merged}) by {login}"
                     )
                     if merged_by:
-                        description = []
-                        try:
-                            raw_labels = is_pr.get("labels", [])
-                            if raw_labels:
-                                installation_id = payload["installation"]["id"]
-                                session = self.auth.session(installation_id)
-                                for raw_label in raw_labels:
-                                    label = session.ghrequest(
-                                        "GET",
-                                        raw_label.get("url", ""),
-                                        override_accept_header=ACCEPT_HEADER_SYMMETRA,
-                                    ).json()
-                                    # apparently can still be none-like ?
-                                    label_desc = label.get("description", "") or ""
-                                    description.append(label_desc.replace("&", "\n"))
-                        except Exception:
-                            import traceback
-
-                            traceback.print_exc()
-                        milestone = is_pr.get("milestone", {})
-                        if milestone:
-                            description.append(milestone.get("description", "") or "")
-                        description_str = "\n".join(description)
-                        if "on-merge:" in description_str and is_pr["base"]["ref"] in (
-                            "master",
-                            "main",
-                        ):
-                            did_backport = False
-                            for description_line in description_str.splitlines():
-                                line = description_line.strip()
-                                if line.startswith("on-merge:"):
-                                    todo = line[len("on-merge:") :].strip()
-                                    self.dispatch_on_mention(
-                                        "@meeseeksdev " + todo,
-                                        payload,
-                                        merged_by["login"],
-                                    )
-                                    did_backport = True
-                            if not did_backport:
-                                print(
-                                    '"on-merge:" found in milestone description, but unable to parse command.',
-                                    'Is "on-merge:" on a separate line?',
-                                )
-                                print(description_str)
-                        else:
-                            print(
-                                f'PR is not targeting main/master branch ({is_pr["base"]["ref"]}),'
-                                'or "on-merge:" not in milestone (or label) description:'
-                            )
-                            print(description_str)
+                        self.queue(Job("merged", payload, user=login))
                     else:
                         print(f"({repo}) Hum, closed, PR but not merged")
                 else:
@@ -390,6 +476,345 @@ class WebHookHandler(MainHandler):
                 # print(f"({repo}) can't deal with `{type_}` yet")
         return self.finish()
 
+    def queue(self, job: Job) -> None:
+        """
+        Hand a job over to the workers and answer with `202 Accepted`.
+
+        While shutting down we answer `503` so that GitHub lets us know the
+        delivery failed, and it can be redelivered once we are back.
+        """
+        delivery = self.request.headers.get("X-GitHub-Delivery")
+        if self.dispatcher.jobs.closed:
+            self.dispatcher.deliveries.forget(delivery)
+            self.set_status(503)
+            return
+        job.delivery = delivery
+        self.dispatcher.jobs.submit(job)
+        self.set_status(202)
+
+
+def user_can(user, command, repo, org, session, conf=None):
+    """
+    callback to test whether the current user has custom permission set on said repository.
+
+    ``conf`` is the repository config file if already known.
+    """
+    if conf is None:
+        try:
+            path = ".meeseeksdev.yml"
+            resp = session.ghrequest(
+                "GET",
+                f"https://api.github.com/repos/{org}/{repo}/contents/{path}",
+                raise_for_status=False,
+            )
+        except Exception:
+            print(red + "An error occurred getting repository config file." + normal)
+            import traceback
+
+            traceback.print_exc()
+            return False, {}
+        conf = {}
+        if resp.status_code == 404:
+            print(yellow + "config file not found" + normal)
+        elif resp.status_code != 200:
+            print(red + f"unknown status code {resp.status_code}" + normal)
+            resp.raise_for_status()
+        else:
+            conf = yaml.safe_load(base64.decodebytes(resp.json()["content"].encode()))
+    if conf:
+        print(green + f"should test if {user} can {command} on {repo}/{org}" + normal)
+
+    if user in conf.get("usr_denylist", []):
+        return False, {}
+
+    user_section = conf.get("users", {}).get(user, {})
+
+    custom_allowed_commands = user_section.get("can", [])
+
+    print(f"Custom allowed command for {user} are", custom_allowed_commands)
+
+    if command in custom_allowed_commands:
+        print(yellow + f"would allow {user} to {command}")
+        if "config" in user_section:
+            user_section_config = user_section.get("config", {})
+            if isinstance(user_section_config, list):
+                print("pop0 from user_config")
+                user_section_config = user_section_config[0]
+            local_config = user_section_config.get(command, None)
+            if local_config:
+                print("returning local_config", local_config)
+                return True, local_config
+        return True, {}
+
+    everyone_section = conf.get("special", {}).get("everyone", {})
+    everyone_allowed_commands = everyone_section.get("can", [])
+
+    print("with everyone taken into account", everyone_allowed_commands)
+    if command in everyone_allowed_commands:
+        print(yellow + f"would allow {user} (via everyone) to do {command}")
+        if "config" in everyone_section:
+            everyone_section_config = everyone_section.get("config", {})
+            if isinstance(everyone_section_config, list):
+                print("pop0 from user_config")
+                everyone_section_config = everyone_section_config[0]
+            local_config = everyone_section_config.get(command, None)
+            if local_config:
+                print("returning local_config", local_config)
+                return True, local_config
+        return True, {}
+
+    print(yellow + f"would not allow {user} to {command}")
+    return False, {}
+
+
+def canonical_names(actions: dict) -> Dict[str, str]:
+    """
+    Map the names of commands to the one their jobs have, the same for all the
+    names of a handler: its own if it is one of them, the first one otherwise.
+    """
+    names: Dict[Callable, List[str]] = {}
+    for name, handler in actions.items():
+        names.setdefault(handler, []).append(name)
+    canonical: Dict[str, str] = {}
+    for handler, aliases in names.items():
+        main = handler.__name__ if handler.__name__ in aliases else aliases[0]
+        canonical.update((alias, main) for alias in aliases)
+    return canonical
+
+
+class Dispatcher:
+    """
+    Run the jobs queued by the webhook handler.
+
+    This is where the slow part of handling a hook lives: talking to GitHub to
+    check permissions, and actually running the commands.
+    """
+
+    def __init__(self, actions, config, auth):
+        self.actions = actions
+        # so that the same command asked by different names is one job.
+        self.aliases = canonical_names(actions)
+        self.config = config
+        self.auth = auth
+        self.store = JobStore(config.job_store)
+        self.workers = WorkerPool(
+            self.run,
+            config.job_store,
+            max_jobs=config.worker_max_jobs,
+            max_rss=config.worker_max_rss,
+            initializer=self.use_store,
+            report=self.report,
+            merge=self.merge,
+        )
+        self.jobs = JobQueue(
+            self.execute,
+            workers={
+                Cost.light.value: config.light_workers,
+                Cost.heavy.value: config.heavy_workers,
+            },
+            store=self.store,
+            repo_limits={Cost.heavy.value: config.repo_concurrency},
+            installation_limits={Cost.heavy.value: config.installation_concurrency},
+            steal_after=config.steal_after if config.job_store != ":memory:" else None,
+            aliases=self.aliases,
+        )
+        self.admission = Admission(self.jobs, shed_threshold=config.shed_threshold)
+        self.deliveries = DeliveryIndex(config.delivery_cache, store=self.store)
+        self.shards = Shards(config.node_url, config.nodes) if config.nodes else None
+        # lookups run_command did not need, in this process.
+        self.skipped_lookups = {"permission": 0, "pull_request": 0, "config": 0}
+
+    @property
+    def mention_bot_re(self):
+        botname = self.config.botname
+        return re.compile("@?" + re.escape(botname) + r"(?:\[bot\])?", re.IGNORECASE)
+
+    def use_store(self, store: JobStore) -> None:
+        """In a worker process, use its own connection to the store."""
+        self.store = store
+        self.auth.store = store
+
+    def report(self) -> dict:
+        """In a worker process, the figures of the jobs since the last report."""
+        skipped = dict(self.skipped_lookups)
+        for lookup in self.skipped_lookups:
+            self.skipped_lookups[lookup] = 0
+        return {
+            "skipped_lookups": skipped,
+            "retries": transports.report(),
+            "rate": budgets.report(),
+        }
+
+    def merge(self, report: dict) -> None:
+        """Add the figures reported by a worker process to ours."""
+        for lookup, count in report["skipped_lookups"].items():
+            self.skipped_lookups[lookup] += count
+        transports.merge(report["retries"])
+        budgets.merge(report["rate"])
+
+    def execute(self, job: Job) -> None:
+        """Run ``job``, in a worker process if it is heavy."""
+        if job.lane == Cost.heavy.value:
+            self.workers.run(job)
+        else:
+            self.run(job)
+
+    def run(self, job: Job) -> None:
+        if job.kind == "command":
+            handler = self.actions.get(job.command)
+            # to be deferred rather than eat up the rate limit.
+            set_low_priority(getattr(handler, "low_priority", False))
+            set_deadline(time.time() + self.config.job_deadline)
+            try:
+                self.run_command(job)
+            finally:
+                set_low_priority(False)
+                set_deadline(None)
+        elif job.kind == "merged":
+            self.run_merged(job)
+        elif job.kind == "installation":
+            self.auth._build_auth_id_mapping()
+        elif job.kind == "reply":
+            payload = job.payload
+            session = self.auth.session(payload["installation"]["id"])
+            issue = payload.get("issue") or payload["pull_request"]
+            session.post_comment(issue["comments_url"], job.arguments)
+        else:
+            print(red + f"don't know how to run {job}" + normal)
+
+    def dispatch_on_mention(self, body: str, payload: dict, user: str) -> list:
+        """
+        Parse the commands out of a comment and return one job per known command.
+
+        Commands refused by admission control are dropped, and replaced by a
+        single job telling the user about it.
+        """
+        org = payload["repository"]["owner"]["login"]
+        repo = payload["repository"]["name"]
+        context = CommentContext()
+        jobs = []
+        refused = []
+        for (command, arguments) in process_mentioning_comment(body, self.mention_bot_re):
+            add_event(
+                "dispatch",
+                {
+                    "mention": {
+                        "user": user,
+                        "organisation": org,
+                        "repository": f"{org}/{repo}",
+                        "command": command,
+                    }
+                },
+            )
+            handler = self.actions.get(command.lower(), None)
+            if not handler:
+                print("unnknown command", command)
+                continue
+            job = Job(
+                "command",
+                payload,
+                user=user,
+                command=self.aliases[command.lower()],
+                arguments=arguments,
+                lane=getattr(handler, "cost", Cost.light).value,
+            )
+            job.context = context
+            reason = self.admission.admit(job, getattr(handler, "low_priority", False))
+            if reason:
+                print(yellow + f"not running {job}: {reason}" + normal)
+                refused.append((job, reason))
+            else:
+                jobs.append(job)
+        if refused and self.admission.should_notify(user):
+            jobs.append(Job("reply", payload, arguments=Admission.message(user, refused)))
+        return jobs
+
+    def supersede(self, payload: dict) -> list:
+        """
+        Restart the commands working on an outdated head of the PR that got new commits.
+        """
+        pull_request = payload["pull_request"]
+        commands = {
+            name
+            for name, handler in self.actions.items()
+            if getattr(handler, "follows_head", False)
+        }
+        return self.jobs.supersede(
+            payload["repository"]["full_name"],
+            pull_request["number"],
+            pull_request["head"]["sha"],
+            commands,
+        )
+
+    def run_merged(self, job: Job) -> None:
+        """
+        A PR was merged, look for `on-merge:` instructions in labels and milestone.
+        """
+        payload = job.payload
+        is_pr = payload["pull_request"]
+        assert job.user is not None
+        description = []
+        try:
+            raw_labels = is_pr.get("labels", [])
+            if raw_labels:
+                installation_id = payload["installation"]["id"]
+                session = self.auth.async_session(installation_id)
+
+                async def get_labels():
+                    return await asyncio.gather(
+                        *(
+                            session.ghrequest(
+                                "GET",
+                                raw_label.get("url", ""),
+                                override_accept_header=ACCEPT_HEADER_SYMMETRA,
+                            )
+                            for raw_label in raw_labels
+                        )
+                    )
+
+                for response in asyncio.run(get_labels()):
+                    label = response.json()
+                    # apparently can still be none-like ?
+                    label_desc = label.get("description", "") or ""
+                    description.append(label_desc.replace("&", "\n"))
+        except Exception:
+            import traceback
+
+            traceback.print_exc()
+        milestone = is_pr.get("milestone", {})
+        if milestone:
+            description.append(milestone.get("description", "") or "")
+        description_str = "\n".join(description)
+        if "on-merge:" in description_str and is_pr["base"]["ref"] in (
+            "master",
+            "main",
+        ):
+            did_backport = False
+            for description_line in description_str.splitlines():
+                line = description_line.strip()
+                if line.startswith("on-merge:"):
+                    todo = line[len("on-merge:") :].strip()
+                    for command_job in self.dispatch_on_mention(
+                        "@meeseeksdev " + todo,
+                        payload,
+                        job.user,
+                    ):
+                        command_job.delivery = job.delivery
+                        self.jobs.submit(command_job)
+                    did_backport = True
+            if not did_backport:
+                print(
+                    '"on-merge:" found in milestone description, but unable to parse command.',
+                    'Is "on-merge:" on a separate line?',
+                )
+                print(description_str)
+        else:
+            print(
+                f'PR is not targeting main/master branch ({is_pr["base"]["ref"]}),'
+                'or "on-merge:" not in milestone (or label) description:'
+            )
+            print(description_str)
+
     # def _action_allowed(args):
     #     """
     #     determine if an action requester can make an action
@@ -401,7 +826,7 @@ class WebHookHandler(MainHandler):
     #       - If pull-request, the requester is the author.
     #     """
 
-    def dispatch_on_mention(self, body: str, payload: dict, user: str) -> None:
+    def run_command(self, job: Job) -> None:
         """
         Core of the logic that let people require actions from the bot.
 
@@ -428,200 +853,169 @@ class WebHookHandler(MainHandler):
               is coming.
 
         """
+        payload = job.payload
+        user = job.user
+        command = job.command
+        arguments = job.arguments
+        assert user is not None
 
         # to dispatch to commands
         installation_id = payload["installation"]["id"]
         org = payload["repository"]["owner"]["login"]
         repo = payload["repository"]["name"]
         pull_request = payload.get("issue", payload).get("pull_request")
-        pr_author = None
-        pr_origin_org_repo = None
-        allow_edit_from_maintainer = None
-        session = self.auth.session(installation_id)
-        if pull_request:
-            # The PR author _may_ not have access to origin branch
-            pr_author = payload.get("issue", {"user": {"login": None}})["user"]["login"]
-            pr = session.ghrequest("GET", pull_request["url"]).json()
-            pr_origin_org_repo = pr["head"]["repo"]["full_name"]
-            origin_repo_org = pr["head"]["user"]["login"]
-            allow_edit_from_maintainer = pr["maintainer_can_modify"]
-
-        # might want to just look at whether the commenter has permission over said branch.
-        # you _may_ have multiple contributors to a PR.
-        is_legitimate_author = (pr_author == user) and (pr_author == origin_repo_org)
-        if is_legitimate_author:
-            print(user, "is legitimate author of this PR, letting commands go through")
-
-        permission_level = session._get_permission(org, repo, user)
-        command_args = process_mentioning_comment(body, self.mention_bot_re)
-        for (command, arguments) in command_args:
-            print("    :: treating", command, arguments)
-            add_event(
-                "dispatch",
-                {
-                    "mention": {
-                        "user": user,
-                        "organisation": org,
-                        "repository": f"{org}/{repo}",
-                        "command": command,
-                    }
-                },
-            )
-            handler = self.actions.get(command.lower(), None)
-            command = command.lower()
-
-            def user_can(user, command, repo, org, session):
-                """
-                callback to test whether the current user has custom permission set on said repository.
-                """
-                try:
-                    path = ".meeseeksdev.yml"
-                    resp = session.ghrequest(
-                        "GET",
-                        f"https://api.github.com/repos/{org}/{repo}/contents/{path}",
-                        raise_for_status=False,
-                    )
-                except Exception:
-                    print(red + "An error occurred getting repository config file." + normal)
-                    import traceback
-
-                    traceback.print_exc()
-                    return False, {}
-                conf = {}
-                if resp.status_code == 404:
-                    print(yellow + "config file not found" + normal)
-                elif resp.status_code != 200:
-                    print(red + f"unknown status code {resp.status_code}" + normal)
-                    resp.raise_for_status()
+        session = job.context.get_session(lambda: self.auth.session(installation_id))
+        print("    :: treating", command, arguments)
+        handler = self.actions[command]
+
+        # Only look up what the rules of the handler need, most commands are
+        # run by people who have the permission, and that is all we need to know.
+        skipped = set(self.skipped_lookups)
+        origin = None
+
+        def pull_request_origin():
+            """Repository and owner of the head of the PR, and whether maintainers can edit it."""
+            nonlocal origin
+            assert user is not None
+            if origin is None:
+                skipped.discard("pull_request")
+                details = job.context.details(session, payload, user)
+                if details is not None:
+                    origin = details.head_repo, details.head_user, details.maintainer_can_modify
                 else:
-                    conf = yaml.safe_load(base64.decodebytes(resp.json()["content"].encode()))
-                    print(green + f"should test if {user} can {command} on {repo}/{org}" + normal)
-                    # print(green + json.dumps(conf, indent=2) + normal)
-
-                if user in conf.get("usr_denylist", []):
-                    return False, {}
-
-                user_section = conf.get("users", {}).get(user, {})
-
-                custom_allowed_commands = user_section.get("can", [])
-
-                print(f"Custom allowed command for {user} are", custom_allowed_commands)
-
-                if command in custom_allowed_commands:
-                    print(yellow + f"would allow {user} to {command}")
-                    if "config" in user_section:
-                        user_section_config = user_section.get("config", {})
-                        if isinstance(user_section_config, list):
-                            print("pop0 from user_config")
-                            user_section_config = user_section_config[0]
-                        local_config = user_section_config.get(command, None)
-                        if local_config:
-                            print("returning local_config", local_config)
-                            return True, local_config
-                    return True, {}
-
-                everyone_section = conf.get("special", {}).get("everyone", {})
-                everyone_allowed_commands = everyone_section.get("can", [])
-
-                print("with everyone taken into account", everyone_allowed_commands)
-                if command in everyone_allowed_commands:
-                    print(yellow + f"would allow {user} (via everyone) to do {command}")
-                    if "config" in everyone_section:
-                        everyone_section_config = everyone_section.get("config", {})
-                        if isinstance(everyone_section_config, list):
-                            print("pop0 from user_config")
-                            everyone_section_config = everyone_section_config[0]
-                        local_config = everyone_section_config.get(command, None)
-                        if local_config:
-                            print("returning local_config", local_config)
-                            return True, local_config
-                    return True, {}
-
-                print(yellow + f"would not allow {user} to {command}")
-                return False, {}
-
-            if handler:
-                print("    :: testing who can use ", str(handler))
-                per_repo_config_allows = None
-                local_config = {}
-                try:
-                    per_repo_config_allows, local_config = user_can(
-                        user, command, repo, org, session
+                    pr = job.context.pull_request(session, pull_request["url"])
+                    origin = (
+                        pr["head"]["repo"]["full_name"],
+                        pr["head"]["user"]["login"],
+                        pr["maintainer_can_modify"],
                     )
-                except Exception:
-                    print(red + "error runnign user_can" + normal)
-                    import traceback
+            return origin
 
-                    traceback.print_exc()
+        print("    :: testing who can use ", str(handler))
+        if handler.scope == Permission.none:
+            permission_level = Permission.none
+        else:
+            skipped.discard("permission")
+            details = job.context.details(session, payload, user)
+            if details is not None and details.permission is not None:
+                permission_level = details.permission
+            else:
+                permission_level = session._get_permission(org, repo, user)
+        has_scope = permission_level.value >= handler.scope.value
 
-                has_scope = permission_level.value >= handler.scope.value
-                if has_scope:
-                    local_config = {}
+        # might want to just look at whether the commenter has permission over said branch.
+        # you _may_ have multiple contributors to a PR.
+        is_legitimate_author = False
+        if not has_scope and pull_request and getattr(handler, "let_author", False):
+            # The PR author _may_ not have access to origin branch
+            pr_author = payload.get("issue", {"user": {"login": None}})["user"]["login"]
+            _, origin_repo_org, _ = pull_request_origin()
+            is_legitimate_author = (pr_author == user) and (pr_author == origin_repo_org)
+            if is_legitimate_author:
+                print(user, "is legitimate author of this PR, letting commands go through")
+
+        per_repo_config_allows = None
+        local_config = {}
+        if not has_scope:
+            skipped.discard("config")
+            details = job.context.details(session, payload, user)
+            try:
+                per_repo_config_allows, local_config = user_can(
+                    user, command, repo, org, session, details.config if details else None
+                )
+            except Exception:
+                print(red + "error runnign user_can" + normal)
+                import traceback
 
-                if (has_scope) or (
-                    is_legitimate_author
-                    and getattr(handler, "let_author", False)
-                    or per_repo_config_allows
-                ):
-                    print(
-                        "    :: authorisation granted ",
-                        handler.scope,
-                        "custom_rule:",
-                        per_repo_config_allows,
-                        local_config,
+                traceback.print_exc()
+
+        if has_scope or is_legitimate_author or per_repo_config_allows:
+            print(
+                "    :: authorisation granted ",
+                handler.scope,
+                "custom_rule:",
+                per_repo_config_allows,
+                local_config,
+            )
+            job.authorize()
+            # commands opting in get the job, to checkpoint their progress.
+            extra = {}
+            if "job" in inspect.signature(handler).parameters:
+                extra["job"] = job
+            cwd = os.getcwd()
+            try:
+                is_gen = inspect.isgeneratorfunction(handler)
+                if inspect.iscoroutinefunction(handler):
+                    # we are in a job thread, with no event loop of its own.
+                    asyncio.run(
+                        handler(
+                            session=AsyncSession(session),
+                            payload=payload,
+                            arguments=arguments,
+                            local_config=local_config,
+                            **extra,
+                        )
                     )
-                    is_gen = inspect.isgeneratorfunction(handler)
+                    maybe_gen = None
+                else:
                     maybe_gen = handler(
                         session=session,
                         payload=payload,
                         arguments=arguments,
                         local_config=local_config,
+                        **extra,
                     )
-                    if is_gen:
-                        gen = YieldBreaker(maybe_gen)
-                        for org_repo in gen:
-                            torg, trepo = org_repo.split("/")
-                            target_session = self.auth.get_session(org_repo)
-
-                            if target_session:
-                                # TODO, if PR, admin and request is on source repo, allows anyway.
-                                # we may need to also check allow edit from maintainer and provide
-                                # another decorator for safety.
-                                # @access_original_branch.
-
-                                if target_session.has_permission(
-                                    torg, trepo, user, Permission.write
-                                ) or (
-                                    pr_origin_org_repo == org_repo and allow_edit_from_maintainer
-                                ):
-                                    gen.send(target_session)
-                                else:
-                                    gen.send(None)
+                if is_gen:
+                    gen = YieldBreaker(maybe_gen)
+                    for org_repo in gen:
+                        torg, trepo = org_repo.split("/")
+                        target_session = self.auth.get_session(org_repo)
+
+                        if target_session:
+                            # TODO, if PR, admin and request is on source repo, allows anyway.
+                            # we may need to also check allow edit from maintainer and provide
+                            # another decorator for safety.
+                            # @access_original_branch.
+
+                            if target_session.has_permission(
+                                torg, trepo, user, Permission.write
+                            ) or (
+                                pull_request
+                                and pull_request_origin()[0] == org_repo
+                                and pull_request_origin()[2]
+                            ):
+                                gen.send(target_session)
                             else:
-                                print("org/repo not found", org_repo, self.auth.idmap)
                                 gen.send(None)
-                else:
-                    try:
-                        comment_url = payload.get("issue", payload.get("pull_request"))[
-                            "comments_url"
-                        ]
-                        user = payload["comment"]["user"]["login"]
-                        session.post_comment(
-                            comment_url,
-                            f"Awww, sorry {user} you do not seem to be allowed to do that, please ask a repository maintainer.",
-                        )
-                    except Exception:
-                        import traceback
+                        else:
+                            print("org/repo not found", org_repo, self.auth.idmap)
+                            gen.send(None)
+            finally:
+                # some commands chdir into their checkout, get back to where we were.
+                os.chdir(cwd)
+        else:
+            job.refused = True
+            try:
+                comment_url = payload.get("issue", payload.get("pull_request"))["comments_url"]
+                user = payload["comment"]["user"]["login"]
+                session.post_comment(
+                    comment_url,
+                    f"Awww, sorry {user} you do not seem to be allowed to do that, please ask a repository maintainer.",
+                )
+            except Exception:
+                import traceback
 
-                        traceback.print_exc()
-                    print(
-                        "I Cannot let you do that: requires",
-                        handler.scope.value,
-                        " you have",
-                        permission_level.value,
-                    )
-            else:
-                print("unnknown command", command)
+                traceback.print_exc()
+            print(
+                "I Cannot let you do that: requires",
+                handler.scope.value,
+                " you have",
+                permission_level.value,
+            )
+        if not pull_request:
+            skipped.discard("pull_request")
+        for lookup in skipped:
+            self.skipped_lookups[lookup] += 1
 
 
 class MeeseeksBox:
@@ -631,32 +1025,177 @@ class MeeseeksBox:
         self.application = None
         self.config = config
         self.port = config.port
+        transports.pool_size = config.http_pool_size
+        responses.size = config.response_cache
         self.auth = Authenticator(
             self.config.integration_id,
             self.config.key,
             self.config.personal_account_token,
             self.config.personal_account_name,
         )
+        # created in each process by `start`, SQLite connections do not survive fork.
+        self.dispatcher: Dispatcher
+        # in the supervising process, the copies of the bot it started, latest last.
+        self.generations: Optional[List[subprocess.Popen]] = None
 
     def sig_handler(self, sig, frame):
         print(yellow, "Caught signal: %s, Shutting down..." % sig, normal)
         add_event("status", {"state": "stopping"})
         IOLoop.instance().add_callback_from_signal(self.shutdown)
 
+    def restart_handler(self, sig, frame):
+        """
+        Start a new copy of the bot, which stops the current one once it is
+        ready to take traffic.
+
+        Both listen on the same port at the same time, which needs ``reuse_port``.
+        """
+        if not self.config.reuse_port:
+            print(red, "Cannot restart without REUSE_PORT, ignoring signal", sig, normal)
+            return
+        if self.generations is None:
+            print(yellow, "Restarts are for the supervising process, ignoring signal", normal)
+            return
+        if len(self.generations) > 1:
+            print(yellow, "Already restarting", normal)
+            return
+        print(yellow, "Caught signal: %s, Restarting..." % sig, normal)
+        add_event("status", {"state": "restarting"})
+        self.spawn(self.generations[-1].pid if self.generations else None)
+
+    def spawn(self, predecessor: Optional[int] = None) -> None:
+        """Start a copy of the bot, to stop ``predecessor`` once it is ready."""
+        assert self.generations is not None
+        env = {**os.environ, GENERATION: "1"}
+        if predecessor:
+            env[PREDECESSOR] = str(predecessor)
+        argv = getattr(sys, "orig_argv", [sys.executable, *sys.argv])
+        self.generations.append(subprocess.Popen(argv, env=env))
+
+    def supervise(self) -> None:
+        """
+        Run the bot in child processes, starting a new one on each SIGHUP.
+
+        This process keeps the PID process managers know, and exits once the
+        last copy of the bot did. SIGTERM and SIGINT are passed on.
+        """
+        self.generations = []
+
+        def stop(sig, frame):
+            print(yellow, "Caught signal: %s, stopping the bot..." % sig, normal)
+            for generation in self.generations or []:
+                generation.send_signal(sig)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, self.restart_handler)
+        self.spawn()
+        returncode = 0
+        while self.generations:
+            time.sleep(0.5)
+            for generation in list(self.generations):
+                if generation.poll() is not None:
+                    print(yellow, f"bot process {generation.pid} exited", normal)
+                    self.generations.remove(generation)
+                    returncode = generation.returncode
+        sys.exit(returncode)
+
     def shutdown(self):
+        """
+        Stop taking new hooks and jobs, and give running jobs until the
+        configured ``drain_timeout`` to finish.
+
+        Jobs that did not finish are left in the journal, for the next start or
+        another process to resume them.
+        """
         print("in shutdown")
         self.server.stop()
+        self.dispatcher.jobs.close()
 
         io_loop = IOLoop.instance()
+        deadline = time.time() + self.config.drain_timeout
 
         def stop_loop():
             print(red, "stopping now...", normal)
+            # they ignore SIGTERM, and would keep running jobs we gave up on.
+            self.dispatcher.workers.stop()
             io_loop.stop()
 
+        def wait_for_jobs():
+            running = self.dispatcher.jobs.running
+            if not running:
+                print(green, "all jobs finished", normal)
+                return stop_loop()
+            if time.time() > deadline:
+                print(red, f"{running} job(s) still running, they will be resumed", normal)
+                self.dispatcher.jobs.release()
+                return stop_loop()
+            print(yellow, f"waiting for {running} job(s) to finish...", normal)
+            io_loop.add_timeout(time.time() + 1, wait_for_jobs)
+
         print(yellow, "stopping soon...", normal)
-        io_loop.add_timeout(time.time() + 5, stop_loop)
+        wait_for_jobs()
+
+    def fork(self) -> None:
+        """
+        Run ``config.processes`` copies of the bot, sharing the listening socket
+        and the job store.
+
+        The process we are in only supervises the others and respawns them if
+        they crash. It dies on SIGTERM/SIGINT, its children notice and drain.
+        Each child works in its own directory, so that checkouts do not collide.
+        """
+        if self.config.job_store == ":memory:":
+            raise ValueError("Several processes need a JOB_STORE file to share their state")
+        self.config.job_store = os.path.abspath(self.config.job_store)
+        handlers = {sig: signal.getsignal(sig) for sig in (signal.SIGTERM, signal.SIGINT)}
+        for sig in handlers:
+            signal.signal(sig, signal.SIG_DFL)
+        task_id = tornado.process.fork_processes(self.config.processes)
+        for sig, handler in handlers.items():
+            signal.signal(sig, handler)
+        # restarts are for the supervising process to do.
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        workdir = f"worker-{task_id}"
+        os.makedirs(workdir, exist_ok=True)
+        os.chdir(workdir)
+        print(green + f"process {task_id} ({os.getpid()}) working in {workdir}" + normal)
+
+        supervisor = os.getppid()
+
+        def check_supervisor():
+            if os.getppid() != supervisor:
+                print(yellow, "supervising process went away", normal)
+                check.stop()
+                self.shutdown()
+
+        check = tornado.ioloop.PeriodicCallback(check_supervisor, 1000)
+        check.start()
 
     def start(self):
+        """
+        Serve hooks and run jobs until told to stop.
+
+        The installation mapping is built before taking any traffic. When
+        started by a supervised restart, the previous process is then told to
+        stop, and it is up to this one to pick up the jobs it leaves behind.
+
+        With ``reuse_port``, this process only supervises the ones serving,
+        for them to be restarted (see :meth:`supervise`).
+        """
+        if self.config.reuse_port and not os.environ.pop(GENERATION, None):
+            return self.supervise()
+        predecessor = os.environ.pop(PREDECESSOR, None)
+        sockets = []
+        if not self.config.reuse_port:
+            # before forking, for all processes to accept on the same socket.
+            sockets = tornado.netutil.bind_sockets(self.port)
+        if self.config.processes != 1:
+            self.fork()
+        self.dispatcher = Dispatcher(self.commands, self.config, self.auth)
+        self.auth.store = self.dispatcher.store
+        self.auth._build_auth_id_mapping(reuse=True)
+
         self.application = tornado.web.Application(
             [
                 (r"/", MainHandler),
@@ -664,22 +1203,36 @@ class MeeseeksBox:
                     r"/webhook",
                     WebHookHandler,
                     {
-                        "actions": self.commands,
                         "config": self.config,
-                        "auth": self.auth,
+                        "dispatcher": self.dispatcher,
                     },
                 ),
+                (r"/metrics", MetricsHandler, {"dispatcher": self.dispatcher}),
             ]
         )
 
         self.server = tornado.httpserver.HTTPServer(self.application)
-        self.server.listen(self.port)
+        if self.config.reuse_port:
+            sockets = tornado.netutil.bind_sockets(self.port, reuse_port=True)
+        self.server.add_sockets(sockets)
 
         # Clear caches once per day.
         callback_time_ms = 1000 * 60 * 60 * 24
         clear_cache_callback = tornado.ioloop.PeriodicCallback(clear_caches, callback_time_ms)
         clear_cache_callback.start()
 
-        loop = IOLoop.instance()
-        loop.add_callback(self.auth._build_auth_id_mapping)
-        loop.start()
+        if self.dispatcher.shards:
+            shards_callback = tornado.ioloop.PeriodicCallback(self.dispatcher.shards.check, 10000)
+            shards_callback.start()
+
+        # with several processes, the first one takes care of the journal.
+        if tornado.process.task_id() in (None, 0):
+            self.dispatcher.store.prune()
+            if predecessor:
+                print(green, f"ready, stopping previous process {predecessor}", normal)
+                os.kill(int(predecessor), signal.SIGTERM)
+            else:
+                self.dispatcher.jobs.resume()
+        self.dispatcher.jobs.start()
+
+        IOLoop.instance().start()
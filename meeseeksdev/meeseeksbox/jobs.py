@@ -0,0 +1,719 @@
+"""
+Background job queue.
+
+Webhooks only validate and enqueue work, commands are run by a pool of worker
+threads so that the IOLoop stays responsive and GitHub gets its answer well
+before the delivery timeout.
+
+Jobs are sorted in lanes by cost class (see :class:`.scopes.Cost`), each lane
+having its own workers. Within a lane, installations are served in turn so that
+a burst of jobs from one organisation does not starve the others.
+
+Several processes can share the same store: each job is claimed in it before
+running, and idle workers pick up jobs other processes are slow to start.
+"""
+import os
+import shutil
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter, deque
+from typing import TYPE_CHECKING, Callable, Deque, Dict, List, Optional, Set
+
+from .context import CommentContext
+from .utils import Cancelled, CancelToken, RateLimited, add_event, set_cancel_token
+
+if TYPE_CHECKING:
+    from .store import JobStore
+
+green = "\033[0;32m"
+yellow = "\033[0;33m"
+red = "\033[0;31m"
+normal = "\033[0m"
+
+
+class Job:
+    """
+    A unit of work to run in the background.
+
+    ``kind`` tells the runner what to do with it:
+
+        - ``command``: run a single command parsed from a mention,
+        - ``merged``: look for ``on-merge:`` instructions on a merged PR,
+        - ``installation``: refresh the installation mapping,
+        - ``reply``: post ``arguments`` as a comment.
+
+    Long running commands record their progress with :meth:`checkpoint`, so
+    that a job interrupted by a restart can skip the phases it already did.
+    Commands working on a PR record the commit they work on in ``head``, so
+    that they can be superseded when new commits are pushed.
+
+    The same command asked again while a job is queued or running is attached
+    to it as a follower, rather than run a second time (see :attr:`key`).
+    Jobs of commands from the same comment share a :class:`.context.CommentContext`.
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        payload: dict,
+        *,
+        user: Optional[str] = None,
+        command: Optional[str] = None,
+        arguments: Optional[str] = None,
+        delivery: Optional[str] = None,
+        lane: str = "light",
+    ):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.lane = lane
+        self.payload = payload
+        self.user = user
+        self.command = command
+        self.arguments = arguments
+        self.delivery = delivery
+        self.status = "queued"
+        self.queued_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.phases: List[str] = []
+        self.workspace: Optional[str] = None
+        self._head: Optional[str] = None
+        self.superseded = False
+        # set when the requester was not allowed to run the command.
+        self.refused = False
+        # set once they were, see authorize().
+        self.authorized = False
+        self.followers: List["Job"] = []
+        # process running the job, as recorded in the store.
+        self.owner: Optional[str] = None
+        self.context = CommentContext()
+        self.token = CancelToken()
+        self.queue: Optional["JobQueue"] = None
+        self._store: Optional["JobStore"] = None
+
+    @property
+    def org(self):
+        return self.payload.get("repository", {}).get("owner", {}).get("login")
+
+    @property
+    def repo(self):
+        return self.payload.get("repository", {}).get("full_name")
+
+    @property
+    def repo_name(self):
+        """Repository name without the org, that is the name of its checkout directory."""
+        return self.payload.get("repository", {}).get("name")
+
+    @property
+    def installation(self):
+        """Who to be fair to when scheduling: the installation, or the org."""
+        return self.payload.get("installation", {}).get("id", self.org)
+
+    @property
+    def number(self):
+        return self.payload.get("issue", self.payload.get("pull_request", {})).get("number")
+
+    @property
+    def key(self) -> tuple:
+        """Jobs with the same key do the same thing."""
+        arguments = " ".join((self.arguments or "").split())
+        return (self.kind, self.repo, self.number, self.command, arguments)
+
+    @property
+    def head(self) -> Optional[str]:
+        """Commit of the PR the job works on."""
+        return self._head
+
+    @head.setter
+    def head(self, value: Optional[str]) -> None:
+        changed = value != self._head
+        self._head = value
+        if changed and self._store:
+            self._store.set_head(self)
+
+    @property
+    def latency(self) -> Optional[float]:
+        """Time spent waiting in the queue before a worker picked the job up."""
+        if self.started_at is None:
+            return None
+        return self.started_at - self.queued_at
+
+    @property
+    def phase(self) -> Optional[str]:
+        """Last completed phase, if any."""
+        return self.phases[-1] if self.phases else None
+
+    def done(self, phase: str) -> bool:
+        """Whether ``phase`` was completed, possibly before a restart."""
+        return phase in self.phases
+
+    def checkpoint(self, phase: str, workspace: Optional[str] = None) -> None:
+        """
+        Record that ``phase`` is completed, and where the work lives on disk.
+
+        Raise :class:`.utils.Cancelled` if the job was cancelled meanwhile.
+        """
+        self.token.check()
+        if phase not in self.phases:
+            self.phases.append(phase)
+        if workspace is not None:
+            self.workspace = workspace
+        print(green + f"{self} reached phase {phase}" + normal)
+        if self._store:
+            self._store.update(self)
+
+    def authorize(self) -> None:
+        """
+        Record that the requester is allowed to run the command, for the same
+        command asked in other processes to be coalesced into this job.
+        """
+        self.authorized = True
+        if self._store:
+            self._store.set_authorized(self)
+
+    def renew(self) -> "Job":
+        """A fresh copy of this job, to start over from scratch."""
+        job = Job(
+            self.kind,
+            self.payload,
+            user=self.user,
+            command=self.command,
+            arguments=self.arguments,
+            delivery=self.delivery,
+            lane=self.lane,
+        )
+        job.context = self.context
+        return job
+
+    def matches(
+        self,
+        repo: str,
+        number: int,
+        command: Optional[str] = None,
+        arguments: Optional[str] = None,
+    ) -> bool:
+        """Whether this is ``command`` (with ``arguments``) on PR/issue ``number`` of ``repo``."""
+        if (self.kind, self.repo, self.number) != ("command", repo, number):
+            return False
+        if command and command != self.command:
+            return False
+        if arguments and " ".join(arguments.split()) != " ".join((self.arguments or "").split()):
+            return False
+        return True
+
+    def __repr__(self):
+        what = self.command or self.kind
+        return f"<Job {self.id[:8]} {what} on {self.repo}#{self.number} ({self.status})>"
+
+
+def _alive(owner: Optional[str]) -> bool:
+    """Whether the process ``owner`` of a job (see :attr:`JobQueue.owner`) is running."""
+    if not owner:
+        return False
+    host, _, pid = owner.rpartition(":")
+    # the store is a local file, jobs of other hosts come from a copy of it.
+    if host != os.uname().nodename:
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue:
+    """
+    FIFOs of :class:`Job`, one per lane, each served by its own threads.
+
+    ``workers`` maps lane names to the number of threads serving them.
+    ``runner`` is called with each job, exceptions are logged and do not kill
+    the worker. When a ``store`` is given, jobs are journaled in it.
+
+    ``repo_limits`` and ``installation_limits`` map lane names to the maximum
+    number of jobs of this lane running at once for a given repository or
+    installation. Lanes that are not listed are not limited. Repositories are
+    compared by name only, as that is the directory they are checked out in.
+
+    ``aliases`` maps the names a command can be asked by to the one its jobs
+    have, see :meth:`cancel`.
+
+    With ``steal_after`` seconds, workers look in the store for jobs that other
+    processes queued but did not start for that long, and run them. Jobs are
+    then cancelled and superseded in other processes too: the request is
+    recorded in the store, and the process running the job checks for them
+    every ``poll_interval`` seconds.
+    """
+
+    poll_interval = 2.0
+
+    def __init__(
+        self,
+        runner: Callable[[Job], None],
+        workers: Optional[Dict[str, int]] = None,
+        store: Optional["JobStore"] = None,
+        repo_limits: Optional[Dict[str, int]] = None,
+        installation_limits: Optional[Dict[str, int]] = None,
+        steal_after: Optional[float] = None,
+        aliases: Optional[Dict[str, str]] = None,
+    ):
+        self.runner = runner
+        self.workers = workers or {"light": 1}
+        self.store = store
+        self.repo_limits = repo_limits or {}
+        self.installation_limits = installation_limits or {}
+        self.steal_after = steal_after
+        self.aliases = aliases or {}
+        self.owner = f"{os.uname().nodename}:{os.getpid()}"
+        self.closed = False
+        # last time (in number of jobs started) each installation got a worker.
+        self._tick = 0
+        self._served: Dict[object, int] = {}
+        self._pending: Dict[str, Deque[Job]] = {lane: deque() for lane in self.workers}
+        self._running: Set[Job] = set()
+        self._cond = threading.Condition()
+        self._threads: list = []
+        self._latencies: Dict[str, Deque[float]] = {
+            lane: deque(maxlen=1000) for lane in self.workers
+        }
+        self._done = 0
+        self._failed = 0
+        self._cancelled = 0
+        self._superseded = 0
+        self._coalesced = 0
+        self._deferred = 0
+
+    def start(self) -> None:
+        for lane, count in self.workers.items():
+            for i in range(count):
+                t = threading.Thread(
+                    target=self._work, args=(lane,), name=f"meeseeks-{lane}-{i}", daemon=True
+                )
+                t.start()
+                self._threads.append(t)
+        if self.store and self.steal_after is not None:
+            t = threading.Thread(target=self._watch, name="meeseeks-watch", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, job: Job) -> Job:
+        if self.closed:
+            raise RuntimeError(f"Queue is closed, cannot accept {job}")
+        if job.lane not in self._pending:
+            raise ValueError(f"No workers for lane {job.lane!r} of {job}")
+        job.queue = self
+        with self._cond:
+            existing = self._duplicate_of(job)
+            if existing is not None:
+                existing.followers.append(job)
+                self._coalesced += 1
+        if existing is None:
+            existing = self._duplicate_in_store(job)
+            if existing is not None:
+                with self._cond:
+                    self._coalesced += 1
+        if existing is not None:
+            print(yellow + f"{job} requested by {job.user} coalesced into {existing}" + normal)
+            add_event("coalesced", {"command": job.command, "user": job.user, "repo": job.repo})
+            return existing
+        if self.store:
+            job._store = self.store
+            self.store.add(job)
+        with self._cond:
+            pending = self._pending[job.lane]
+            pending.append(job)
+            self._cond.notify_all()
+        print(green + f"queued {job} in {job.lane} lane, {len(pending)} pending" + normal)
+        return job
+
+    def _duplicate_of(self, job: Job) -> Optional[Job]:
+        """
+        A queued or running job doing the same as ``job``, if any.
+
+        Jobs whose requester was refused do not count, nor do cancelled ones,
+        unless they are going to be restarted.
+        """
+        if job.kind != "command" or job.number is None:
+            return None
+        for other in [*self._pending[job.lane], *self._running]:
+            if other.key != job.key or other.refused:
+                continue
+            if other.token.cancelled and not other.superseded:
+                continue
+            return other
+        return None
+
+    def _known(self) -> Set[str]:
+        """IDs of the jobs this process queued or runs."""
+        with self._cond:
+            return {j.id for p in self._pending.values() for j in p} | {j.id for j in self._running}
+
+    def _duplicate_in_store(self, job: Job) -> Optional[Job]:
+        """
+        A job doing the same as ``job`` another process runs, if any.
+
+        ``job`` cannot follow it across processes, so it is only coalesced into
+        jobs whose requester was allowed to run them: ``job`` would be dropped
+        with them if they were refused.
+        """
+        if not self.store or job.kind != "command" or job.number is None:
+            return None
+        known = self._known()
+        for other in self.store.unfinished():
+            if other.id == job.id or other.id in known or not other.authorized:
+                continue
+            if other.key == job.key:
+                return other
+        return None
+
+    def resume(self, max_age: float = 24 * 3600) -> None:
+        """
+        Queue again the jobs the journal says did not finish.
+
+        Jobs older than ``max_age`` seconds are abandoned, they likely crash
+        the process or nobody is waiting for them anymore. Jobs still running
+        in a live process, a sibling of one that got respawned, are left alone.
+        """
+        if not self.store:
+            return
+        for job in self.store.unfinished():
+            if job.status == "running" and _alive(job.owner):
+                continue
+            if job.queued_at < time.time() - max_age:
+                print(red + f"abandoning {job}, it is too old" + normal)
+                job.status = "abandoned"
+                self.store.update(job)
+                continue
+            print(yellow + f"resuming {job}, last phase: {job.phase}" + normal)
+            job.status = "queued"
+            self.submit(job)
+
+    def cancel(
+        self,
+        repo: str,
+        number: int,
+        command: Optional[str] = None,
+        arguments: Optional[str] = None,
+        exclude: Optional[Job] = None,
+    ) -> List[Job]:
+        """
+        Cancel the commands on PR/issue ``number`` of ``repo``, optionally only
+        ``command`` with ``arguments``.
+
+        Pending jobs are dropped; running ones have their subprocesses killed and
+        stop at their next subprocess or checkpoint, after which their workspace
+        is removed. ``command`` can be any of its :attr:`aliases`.
+        """
+        if command:
+            command = self.aliases.get(command, command)
+        cancelled = []
+        with self._cond:
+            for pending in self._pending.values():
+                for job in list(pending):
+                    if job.matches(repo, number, command, arguments):
+                        pending.remove(job)
+                        job.status = "cancelled"
+                        cancelled.append(job)
+            self._cancelled += len(cancelled)
+            running = [
+                job
+                for job in self._running
+                if job is not exclude and job.matches(repo, number, command, arguments)
+            ]
+        for job in cancelled:
+            job.token.cancel()
+            if self.store:
+                self.store.update(job)
+        for job in running:
+            job.token.cancel()
+        elsewhere = []
+        if self.store:
+            known = self._known() | {j.id for j in cancelled} | {exclude.id if exclude else ""}
+            for job in self.store.unfinished():
+                if job.id in known or not job.matches(repo, number, command, arguments):
+                    continue
+                if self.store.cancel_queued(job):
+                    with self._cond:
+                        self._cancelled += 1
+                    elsewhere.append(job)
+                elif self.store.request(job, "cancel"):
+                    elsewhere.append(job)
+        return cancelled + running + elsewhere
+
+    def supersede(self, repo: str, number: int, head: str, commands: Set[str]) -> List[Job]:
+        """
+        New commits were pushed to PR ``number`` of ``repo``, ``head`` being the
+        latest one.
+
+        Running ``commands`` that work on an older commit are cancelled and
+        queued again, to start over on ``head``. Pending ones will pick up
+        ``head`` when they start, once the PR data they may share with previous
+        commands is forgotten.
+        """
+        with self._cond:
+            for job in [*self._running, *(j for p in self._pending.values() for j in p)]:
+                if job.matches(repo, number):
+                    job.context.forget_pull_requests()
+            stale = [
+                job
+                for job in self._running
+                if job.command in commands
+                and job.matches(repo, number)
+                and job.head not in (None, head)
+            ]
+        for job in stale:
+            print(yellow + f"{job} works on {job.head}, superseded by {head}" + normal)
+            job.superseded = True
+            job.token.cancel()
+        if self.store:
+            known = self._known()
+            for job in self.store.unfinished():
+                if (
+                    job.id not in known
+                    and job.status == "running"
+                    and job.command in commands
+                    and job.matches(repo, number)
+                    and job.head not in (None, head)
+                    and self.store.request(job, "supersede")
+                ):
+                    print(yellow + f"{job} works on {job.head}, asked to supersede it" + normal)
+                    stale.append(job)
+        return stale
+
+    def _watch(self) -> None:
+        """Stop the jobs other processes asked to cancel or supersede."""
+        assert self.store is not None
+        while not self.closed:
+            time.sleep(self.poll_interval)
+            try:
+                requests = dict(self.store.requests(self.owner))
+            except Exception:
+                traceback.print_exc()
+                continue
+            with self._cond:
+                jobs = [j for j in self._running if j.id in requests and not j.token.cancelled]
+            for job in jobs:
+                print(yellow + f"{job} asked to {requests[job.id]} by another process" + normal)
+                if requests[job.id] == "supersede":
+                    job.superseded = True
+                    job.context.forget_pull_requests()
+                job.token.cancel()
+
+    def release(self) -> List[Job]:
+        """
+        Give up on running jobs, for another process to resume them from their
+        last phase. Only to be done right before exiting.
+        """
+        with self._cond:
+            running = list(self._running)
+        for job in running:
+            job.status = "queued"
+            if self.store:
+                self.store.set_status(job)
+        return running
+
+    def close(self) -> None:
+        """Stop accepting and starting jobs, pending ones stay in the journal."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def drain(self, timeout: float) -> bool:
+        """Wait up to ``timeout`` seconds for running jobs, return whether all finished."""
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._running:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    @property
+    def running(self) -> int:
+        return len(self._running)
+
+    def _select(self, lane: str) -> Optional[Job]:
+        """
+        Pick the next job to run in ``lane``, if any can run.
+
+        Jobs over their repository or installation limit are skipped, and among
+        the others we pick the oldest job of the installation that has been
+        waiting the longest for a worker.
+        """
+        running = [j for j in self._running if j.lane == lane]
+        repo_limit = self.repo_limits.get(lane)
+        installation_limit = self.installation_limits.get(lane)
+        by_repo = Counter(str(j.repo_name).lower() for j in running)
+        by_installation = Counter(j.installation for j in running)
+        best = None
+        for job in self._pending[lane]:
+            if repo_limit and by_repo[str(job.repo_name).lower()] >= repo_limit:
+                continue
+            if installation_limit and by_installation[job.installation] >= installation_limit:
+                continue
+            turn = self._served.get(job.installation, -1)
+            if best is None or turn < self._served.get(best.installation, -1):
+                best = job
+        return best
+
+    def _steal(self, lane: str) -> bool:
+        """Take over the jobs of ``lane`` other processes did not start, return if any."""
+        assert self.store is not None and self.steal_after is not None
+        known = {j.id for j in self._pending[lane]} | {j.id for j in self._running}
+        stolen = [
+            job
+            for job in self.store.queued(lane, time.time() - self.steal_after)
+            if job.id not in known
+        ]
+        for job in stolen:
+            print(yellow + f"picking up {job}, queued by another process" + normal)
+            job.queue = self
+            job._store = self.store
+            self._pending[lane].append(job)
+        return bool(stolen)
+
+    def _next(self, lane: str) -> Optional[Job]:
+        with self._cond:
+            while True:
+                if self.closed:
+                    return None
+                job = self._select(lane)
+                if job is not None:
+                    self._pending[lane].remove(job)
+                    if self.store and not self.store.claim(job, self.owner):
+                        print(yellow + f"{job} was claimed or cancelled elsewhere" + normal)
+                        continue
+                    break
+                if self.store and self.steal_after is not None and self._steal(lane):
+                    continue
+                self._cond.wait(self.steal_after)
+            self._running.add(job)
+            self._tick += 1
+            self._served[job.installation] = self._tick
+            return job
+
+    def _work(self, lane: str) -> None:
+        while True:
+            job = self._next(lane)
+            if job is None:
+                return
+            self._execute(job)
+
+    def _execute(self, job: Job) -> None:
+        job.status = "running"
+        job.started_at = time.time()
+        if self.store:
+            self.store.update(job)
+        latency = job.started_at - job.queued_at
+        self._latencies[job.lane].append(latency)
+        add_event(
+            "job",
+            {"kind": job.kind, "command": job.command, "lane": job.lane, "latency": latency},
+        )
+        print(green + f"starting {job} after {latency:.2f}s in queue" + normal)
+        set_cancel_token(job.token)
+        delay = 0.0
+        try:
+            job.token.check()
+            self.runner(job)
+            # the job may have swallowed the failure of its killed processes.
+            job.token.check()
+            job.status = "done"
+        except RateLimited as e:
+            job.status = "deferred"
+            delay = e.delay
+            print(yellow + f"{job} deferred by {delay:.0f}s, the rate limit is low" + normal)
+        except Cancelled:
+            job.status = "superseded" if job.superseded else "cancelled"
+            print(yellow + f"{job} was {job.status}" + normal)
+            if job.workspace:
+                print(yellow + f"removing {job.workspace}" + normal)
+                shutil.rmtree(job.workspace, ignore_errors=True)
+        except Exception:
+            if self.closed:
+                # likely killed along with us, e.g. on a dyno restart.
+                job.status = "queued"
+                print(yellow + f"{job} interrupted by shutdown, it will be resumed" + normal)
+            else:
+                job.status = "failed"
+                print(red + f"{job} crashed" + normal)
+            traceback.print_exc()
+        finally:
+            set_cancel_token(None)
+            job.finished_at = time.time()
+            if self.store:
+                self.store.update(job)
+            with self._cond:
+                self._running.discard(job)
+                if job.status == "done":
+                    self._done += 1
+                elif job.status == "cancelled":
+                    self._cancelled += 1
+                elif job.status == "superseded":
+                    self._superseded += 1
+                elif job.status == "deferred":
+                    self._deferred += 1
+                else:
+                    self._failed += 1
+                self._cond.notify_all()
+        follow_up = None
+        if job.status in ("superseded", "deferred"):
+            follow_up = job.renew()
+            follow_up.followers = job.followers
+        elif job.refused and job.followers:
+            # someone else asked, they may be allowed to.
+            follow_up = job.followers[0]
+            follow_up.followers = job.followers[1:]
+        if follow_up is None:
+            return
+        if delay:
+            # journaled now, not to be lost nor stolen before its time.
+            follow_up.queued_at = time.time() + delay
+            if self.store:
+                self.store.add(follow_up)
+            timer = threading.Timer(delay, self._follow_up, (follow_up,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._follow_up(follow_up)
+
+    def _follow_up(self, job: Job) -> None:
+        if not self.closed:
+            self.submit(job)
+        elif self.store:
+            # will be picked up by resume() on next start.
+            self.store.add(job)
+
+    def stats(self) -> dict:
+        """Queue figures to help sizing the worker pools."""
+        with self._cond:
+            lanes: dict = {}
+            for lane, count in self.workers.items():
+                latencies = sorted(self._latencies[lane])
+                lanes[lane] = {
+                    "workers": count,
+                    "pending": len(self._pending[lane]),
+                    "running": len([j for j in self._running if j.lane == lane]),
+                    "pending_by_org": dict(Counter(str(j.org) for j in self._pending[lane])),
+                }
+                if latencies:
+                    lanes[lane]["latency"] = {
+                        "p50": latencies[len(latencies) // 2],
+                        "p90": latencies[int(len(latencies) * 0.9)],
+                        "max": latencies[-1],
+                    }
+            return {
+                "pending": sum(len(p) for p in self._pending.values()),
+                "running": len(self._running),
+                "done": self._done,
+                "failed": self._failed,
+                "cancelled": self._cancelled,
+                "superseded": self._superseded,
+                "coalesced": self._coalesced,
+                "deferred": self._deferred,
+                "lanes": lanes,
+            }
@@ -35,3 +35,30 @@ def everyone(function):
 def pr_author(function):
     function.let_author = True
     return function
+
+
+class Cost(Enum):
+    """
+    How expensive a command is to run, each cost class is served by its own
+    workers so that cheap commands do not wait behind git operations.
+    """
+
+    light = "light"
+    heavy = "heavy"
+
+
+def heavy(function):
+    function.cost = Cost.heavy
+    return function
+
+
+def low_priority(function):
+    """Commands that are the first to be dropped when the bot is overloaded."""
+    function.low_priority = True
+    return function
+
+
+def follows_head(function):
+    """Commands working on the head of a PR, to start over when new commits are pushed."""
+    function.follows_head = True
+    return function
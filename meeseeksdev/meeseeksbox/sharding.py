@@ -0,0 +1,86 @@
+"""
+Spread installations across several bot nodes.
+
+Each node owns the installations that hash next to it on a ring, so that all
+the hooks of an installation are handled by the same node, and its checkouts
+and caches stay warm. Nodes that stop answering are taken out of the ring,
+their installations move to the next nodes and come back when they do.
+"""
+import bisect
+import hashlib
+from typing import List, Optional, Sequence, Set, Tuple
+
+from tornado.httpclient import AsyncHTTPClient
+
+green = "\033[0;32m"
+yellow = "\033[0;33m"
+normal = "\033[0m"
+
+
+def _hash(key: str) -> int:
+    return int(hashlib.md5(key.encode()).hexdigest(), 16)
+
+
+class HashRing:
+    """
+    Consistent hashing of keys to ``nodes``.
+
+    Each node is placed ``replicas`` times on the ring to even out the load;
+    removing a node only moves the keys it owned.
+    """
+
+    def __init__(self, nodes: Sequence[str], replicas: int = 64):
+        self.replicas = replicas
+        self._ring: List[Tuple[int, str]] = sorted(
+            (_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas)
+        )
+        self._hashes = [h for h, _ in self._ring]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._ring:
+            return None
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._ring)
+        return self._ring[i][1]
+
+
+class Shards:
+    """
+    Which node owns which installation.
+
+    ``me`` is the webhook URL of this node, ``nodes`` the ones of all nodes,
+    this one included. ``check`` is to be called periodically to follow nodes
+    leaving and joining.
+    """
+
+    def __init__(self, me: str, nodes: Sequence[str]):
+        if not me:
+            raise ValueError("NODE_URL must be set to this node's webhook URL when NODES is")
+        self.me = me
+        self.nodes = sorted(set(nodes) | {me})
+        self.alive: Set[str] = set(self.nodes)
+        self.ring = HashRing(self.nodes)
+
+    def owner(self, installation: object) -> str:
+        return self.ring.owner(str(installation)) or self.me
+
+    def set_alive(self, node: str, alive: bool) -> None:
+        if (node in self.alive) == alive or node == self.me:
+            return
+        if alive:
+            print(green + f"node {node} joined, rebalancing installations" + normal)
+            self.alive.add(node)
+        else:
+            print(yellow + f"node {node} left, rebalancing installations" + normal)
+            self.alive.discard(node)
+        self.ring = HashRing(sorted(self.alive))
+
+    async def check(self) -> None:
+        client = AsyncHTTPClient()
+        for node in self.nodes:
+            if node == self.me:
+                continue
+            try:
+                await client.fetch(node, request_timeout=5)
+                self.set_alive(node, True)
+            except Exception:
+                self.set_alive(node, False)
@@ -0,0 +1,320 @@
+"""
+Persistent journal of the jobs accepted by the bot.
+
+Every job is recorded when queued, and updated as it goes through its phases
+(fork, clone, cherry-pick, push...). On restart, jobs that did not finish are
+picked up again from their last completed phase.
+
+The IDs of the webhook deliveries we handled are kept too, so that hooks
+GitHub redelivers after a timeout are not acted upon twice.
+
+When the bot runs as several processes, they all use the same store: to
+claim queued jobs, and to share installation tokens and other cached values.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from .jobs import Job
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    lane TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    user TEXT,
+    command TEXT,
+    arguments TEXT,
+    delivery TEXT,
+    status TEXT NOT NULL,
+    phases TEXT NOT NULL DEFAULT '[]',
+    workspace TEXT,
+    queued_at REAL,
+    started_at REAL,
+    finished_at REAL,
+    owner TEXT,
+    head TEXT,
+    request TEXT,
+    authorized INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE TABLE IF NOT EXISTS deliveries (
+    id TEXT PRIMARY KEY,
+    received_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+"""
+Columns added to the jobs table since it was first created, with their type.
+"""
+MIGRATIONS: List[Tuple[str, str]] = [
+    ("owner", "TEXT"),
+    ("head", "TEXT"),
+    ("request", "TEXT"),
+    ("authorized", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+UNFINISHED = ("queued", "running")
+
+
+class JobStore:
+    """
+    SQLite backed journal, safe to share between the worker threads.
+
+    ``path`` can be ``":memory:"`` for a journal that does not survive the
+    process nor is shared with others, which is what the tests use.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        if path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        columns = {row["name"] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        for column, type_ in MIGRATIONS:
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {type_}")
+
+    def add(self, job: Job) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO jobs VALUES "
+                "(:id, :kind, :lane, :payload, :user, :command, :arguments, :delivery, "
+                ":status, :phases, :workspace, :queued_at, :started_at, :finished_at, NULL, "
+                ":head, NULL, :authorized)",
+                self._row(job),
+            )
+
+    def claim(self, job: Job, owner: str) -> bool:
+        """
+        Mark ``job`` as taken by ``owner``, return whether nobody took it before.
+        """
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE jobs SET status='running', owner=? WHERE id=? AND status='queued'",
+                (owner, job.id),
+            )
+        return cursor.rowcount == 1
+
+    def queued(self, lane: str, before: float) -> List[Job]:
+        """Jobs of ``lane`` nobody picked up since ``before``."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM jobs WHERE status='queued' AND lane=? AND queued_at < ? "
+                "ORDER BY queued_at",
+                (lane, before),
+            ).fetchall()
+        return [self._job(row) for row in rows]
+
+    def update(self, job: Job) -> None:
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status=:status, phases=:phases, workspace=:workspace, "
+                "started_at=:started_at, finished_at=:finished_at, head=:head WHERE id=:id",
+                self._row(job),
+            )
+
+    def set_status(self, job: Job) -> None:
+        """Record the status of ``job`` only, its progress may be newer in the store."""
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status=? WHERE id=?", (job.status, job.id))
+
+    def set_authorized(self, job: Job) -> None:
+        """Record that the requester of ``job`` may run it, for others to coalesce into it."""
+        with self._lock:
+            self._db.execute("UPDATE jobs SET authorized=1 WHERE id=?", (job.id,))
+
+    def set_head(self, job: Job) -> None:
+        """Record the commit ``job`` works on, for other processes to supersede it."""
+        with self._lock:
+            self._db.execute("UPDATE jobs SET head=? WHERE id=?", (job.head, job.id))
+
+    def unfinished(self) -> List[Job]:
+        """
+        Jobs that are queued or running, or were when their process went away.
+
+        Jobs that were asked to stop are left out.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM jobs WHERE status IN (?, ?) AND request IS NULL "
+                "ORDER BY queued_at",
+                UNFINISHED,
+            ).fetchall()
+        return [self._job(row) for row in rows]
+
+    def cancel_queued(self, job: Job) -> bool:
+        """Cancel ``job`` if no process started it yet, return whether it was."""
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE jobs SET status='cancelled', finished_at=? WHERE id=? AND status='queued'",
+                (time.time(), job.id),
+            )
+        return cursor.rowcount == 1
+
+    def request(self, job: Job, request: str) -> bool:
+        """
+        Ask the process running ``job`` to ``cancel`` or ``supersede`` it, return
+        whether it is still running.
+        """
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE jobs SET request=? WHERE id=? AND status='running'", (request, job.id)
+            )
+        return cursor.rowcount == 1
+
+    def requests(self, owner: str) -> List[Tuple[str, str]]:
+        """IDs of the jobs ``owner`` runs that other processes want stopped, and why."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, request FROM jobs "
+                "WHERE owner=? AND status='running' AND request IS NOT NULL",
+                (owner,),
+            ).fetchall()
+        return [(row["id"], row["request"]) for row in rows]
+
+    def add_delivery(self, delivery: str) -> bool:
+        """Record ``delivery``, return whether it is new."""
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO deliveries VALUES (?, ?)", (delivery, time.time())
+            )
+        return cursor.rowcount == 1
+
+    def remove_delivery(self, delivery: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM deliveries WHERE id=?", (delivery,))
+
+    def deliveries(self, limit: int) -> List[str]:
+        """The ``limit`` most recent delivery IDs, oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id FROM deliveries ORDER BY received_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [row["id"] for row in reversed(rows)]
+
+    def prune(self, max_age: float = 7 * 24 * 3600) -> None:
+        """Forget about finished jobs and deliveries older than ``max_age`` seconds."""
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM jobs WHERE status NOT IN (?, ?) AND finished_at < ?",
+                (*UNFINISHED, time.time() - max_age),
+            )
+            self._db.execute(
+                "DELETE FROM deliveries WHERE received_at < ?", (time.time() - max_age,)
+            )
+            self._db.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+
+    def cache_get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM cache WHERE key=? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return row["value"] if row else None
+
+    def cache_set(self, key: str, value: str, ttl: float) -> None:
+        """Share ``value`` with the other processes for ``ttl`` seconds."""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)", (key, value, time.time() + ttl)
+            )
+
+    @staticmethod
+    def _row(job: Job) -> dict:
+        return {
+            "id": job.id,
+            "kind": job.kind,
+            "lane": job.lane,
+            "payload": json.dumps(job.payload),
+            "user": job.user,
+            "command": job.command,
+            "arguments": job.arguments,
+            "delivery": job.delivery,
+            "status": job.status,
+            "phases": json.dumps(job.phases),
+            "workspace": job.workspace,
+            "queued_at": job.queued_at,
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+            "head": job.head,
+            "authorized": int(job.authorized),
+        }
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> Job:
+        job = Job(
+            row["kind"],
+            json.loads(row["payload"]),
+            user=row["user"],
+            command=row["command"],
+            arguments=row["arguments"],
+            delivery=row["delivery"],
+            lane=row["lane"],
+        )
+        job.id = row["id"]
+        job.status = row["status"]
+        job.phases = json.loads(row["phases"])
+        job.workspace = row["workspace"]
+        job.queued_at = row["queued_at"]
+        job.owner = row["owner"]
+        job.head = row["head"]
+        job.authorized = bool(row["authorized"])
+        return job
+
+
+class DeliveryIndex:
+    """
+    The last ``size`` webhook delivery IDs we got, least recently seen first.
+
+    When a ``store`` is given, IDs are persisted in it and reloaded on start,
+    so that redeliveries of hooks received before a restart, or by another
+    process, are caught too.
+    """
+
+    def __init__(self, size: int = 10000, store: Optional[JobStore] = None):
+        self.size = size
+        self.store = store
+        self.duplicates = 0
+        self._lock = threading.Lock()
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        if store:
+            self._seen.update((delivery, None) for delivery in store.deliveries(size))
+
+    def seen(self, delivery: Optional[str]) -> bool:
+        """Whether ``delivery`` was already received, recording it if not."""
+        if not delivery:
+            return False
+        with self._lock:
+            if delivery in self._seen:
+                self._seen.move_to_end(delivery)
+                self.duplicates += 1
+                return True
+            self._seen[delivery] = None
+            if len(self._seen) > self.size:
+                self._seen.popitem(last=False)
+        if self.store and not self.store.add_delivery(delivery):
+            with self._lock:
+                self.duplicates += 1
+            return True
+        return False
+
+    def forget(self, delivery: Optional[str]) -> None:
+        """Let ``delivery`` be handled again, when we could not take care of it."""
+        if not delivery:
+            return
+        with self._lock:
+            self._seen.pop(delivery, None)
+        if self.store:
+            self.store.remove_delivery(delivery)
@@ -1,19 +1,50 @@
 """
 Utility functions to work with github.
 """
+import asyncio
+import copy
 import datetime
 import json
+import os
 import pipes
+import random
 import re
 import shlex
+import signal
 import subprocess
-from typing import Any, Dict, Optional, cast
+import threading
+import time
+import traceback
+import weakref
+from collections import OrderedDict, deque
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    Iterator,
+    Optional,
+    Set,
+    Tuple,
+    cast,
+)
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
+import git.cmd
 import jwt
 import requests
+import requests.adapters
+from requests.structures import CaseInsensitiveDict
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
 
 from .scopes import Permission
 
+if TYPE_CHECKING:
+    from .store import JobStore
+
 green = "\033[0;32m"
 yellow = "\033[0;33m"
 red = "\033[0;31m"
@@ -36,6 +67,39 @@ specific repository.
 """
 RELINK_RE = re.compile(r"(?:(?<=[:,\s])|(?<=^))(#\d+)\\b")
 
+"""
+How long the installation mapping shared between processes stays valid, in
+seconds. New installations are picked up anyway when we get their webhook.
+"""
+IDMAP_TTL = 24 * 3600
+
+"""
+Installation tokens are refreshed in the background when they expire in less
+than that many seconds, and not used anymore in the last minute.
+"""
+TOKEN_REFRESH = 5 * 60
+
+"""
+(connect, read) timeouts of requests in seconds, for each class of endpoint:
+getting tokens, reading, writing, and forwarding hooks to other nodes.
+
+Requests that do not change anything although they are not a GET, like GraphQL
+queries, are of the "read" class: they are retried and do not count against
+the limits on creating content.
+"""
+TIMEOUTS: Dict[str, Tuple[float, float]] = {
+    "token": (5, 10),
+    "read": (5, 30),
+    "write": (5, 60),
+    "forward": (5, 10),
+}
+
+"""
+How many times to retry requests failing for reasons that may go away.
+"""
+RETRIES = 3
+IDEMPOTENT = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
 
 def add_event(*args):
     """Attempt to add an event to keen, print the event otherwise"""
@@ -48,12 +112,205 @@ def add_event(*args):
         print(f"   {args}")
 
 
+class Cancelled(BaseException):
+    """
+    Raised in a job that got cancelled.
+
+    This is not an ``Exception`` so that the catch-all error handling of
+    commands lets it through.
+    """
+
+
+class RateLimited(BaseException):
+    """
+    Raised in low priority work when there is not much left of the rate limit,
+    for the job to be run ``delay`` seconds later.
+
+    Like :class:`Cancelled`, not an ``Exception``, to get through commands.
+    """
+
+    def __init__(self, delay: float):
+        super().__init__(delay)
+        self.delay = delay
+
+
+class CancelToken:
+    """
+    Cancellation state of a job, and the subprocesses it is waiting on.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._processes: Set[subprocess.Popen] = set()
+        self._lock = threading.Lock()
+
+    def check(self) -> None:
+        if self.cancelled:
+            raise Cancelled()
+
+    def cancel(self) -> None:
+        """Mark as cancelled and kill running subprocesses with their children."""
+        with self._lock:
+            self.cancelled = True
+            processes = list(self._processes)
+        for process in processes:
+            self._kill(process)
+
+    @staticmethod
+    def _kill(process: subprocess.Popen) -> None:
+        print(red + f"killing {process.args!r}" + normal)
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def add(self, process: subprocess.Popen) -> None:
+        with self._lock:
+            # GitPython does not tell when its processes are done.
+            self._processes = {p for p in self._processes if p.poll() is None}
+            self._processes.add(process)
+            cancelled = self.cancelled
+        if cancelled:
+            # cancelled while the process was starting.
+            self._kill(process)
+
+    def discard(self, process: subprocess.Popen) -> None:
+        with self._lock:
+            self._processes.discard(process)
+
+
+_local = threading.local()
+
+
+def set_cancel_token(token: Optional[CancelToken]) -> None:
+    """Set the token of the job running in the current thread."""
+    _local.token = token
+
+
+def _check_cancelled() -> None:
+    token: Optional[CancelToken] = getattr(_local, "token", None)
+    if token is not None:
+        token.check()
+
+
+def _cancellable(popen: Callable[..., subprocess.Popen]) -> Callable[..., subprocess.Popen]:
+    """Register the processes started by a job with its token, like :func:`run` does."""
+
+    def wrapper(*args: Any, **kwargs: Any) -> subprocess.Popen:
+        token: Optional[CancelToken] = getattr(_local, "token", None)
+        if token is None:
+            return popen(*args, **kwargs)
+        token.check()
+        kwargs.setdefault("start_new_session", True)
+        process = popen(*args, **kwargs)
+        token.add(process)
+        return process
+
+    return wrapper
+
+
+# fetch, push, cherry-pick... of GitPython all start their git process here.
+git.cmd.safer_popen = _cancellable(git.cmd.safer_popen)
+
+
+def set_low_priority(low: bool) -> None:
+    """Whether the job running in the current thread can wait for more rate limit."""
+    _local.low_priority = low
+
+
+class DeadlineExceeded(Exception):
+    """The job making a request is out of time."""
+
+
+def set_deadline(deadline: Optional[float]) -> None:
+    """Timestamp after which requests of the job running in the current thread fail."""
+    _local.deadline = deadline
+
+
+def _time_left() -> Optional[float]:
+    deadline: Optional[float] = getattr(_local, "deadline", None)
+    if deadline is None:
+        return None
+    left = deadline - time.time()
+    if left <= 0:
+        raise DeadlineExceeded()
+    return left
+
+
+def _mutates(method: str, endpoint: Optional[str] = None) -> bool:
+    """Whether a request may change something on GitHub."""
+    return method not in ("GET", "HEAD") and endpoint != "read"
+
+
+def _timeout(method: str, endpoint: Optional[str] = None) -> Tuple[float, float]:
+    """Timeouts of a request, within the deadline of the current job if any."""
+    if endpoint is None:
+        endpoint = "write" if _mutates(method) else "read"
+    connect, read = TIMEOUTS[endpoint]
+    left = _time_left()
+    if left is not None:
+        connect, read = min(connect, left), min(read, left)
+    return connect, read
+
+
+def _retry_delay(
+    method: str,
+    attempt: int,
+    response: Optional[requests.Response] = None,
+    endpoint: Optional[str] = None,
+) -> Optional[float]:
+    """
+    How long to wait before trying a request again, ``None`` not to.
+
+    ``response`` is ``None`` when there was no answer at all. Requests GitHub
+    tells us to try again after a while were refused, they are retried whatever
+    their method, others only when idempotent or reads.
+    """
+    if attempt >= RETRIES:
+        return None
+    if response is not None and "Retry-After" in response.headers:
+        if response.status_code not in (403, 429, 503):
+            return None
+        delay = float(response.headers["Retry-After"])
+    elif method not in IDEMPOTENT and endpoint != "read":
+        return None
+    elif response is None or response.status_code in (502, 503, 504):
+        # exponential backoff, with full jitter.
+        delay = random.uniform(0, min(30, 2**attempt))
+    else:
+        return None
+    left = _time_left()
+    if left is not None and delay > left:
+        return None
+    return delay
+
+
 def run(cmd, **kwargs):
-    """Print a command and then run it."""
+    """Print a command and then run it.
+
+    When run by a job, the command is killed along with its children if the job
+    gets cancelled, and :class:`Cancelled` is raised.
+    """
     if isinstance(cmd, str):
         cmd = shlex.split(cmd)
     print(" ".join(map(pipes.quote, cmd)))
-    return subprocess.run(cmd, **kwargs)
+    token = getattr(_local, "token", None)
+    if token is None:
+        return subprocess.run(cmd, **kwargs)
+
+    token.check()
+    check = kwargs.pop("check", False)
+    with subprocess.Popen(cmd, start_new_session=True, **kwargs) as process:
+        token.add(process)
+        try:
+            stdout, stderr = process.communicate()
+        finally:
+            token.discard(process)
+    token.check()
+    completed = subprocess.CompletedProcess(process.args, process.returncode, stdout, stderr)
+    if check:
+        completed.check_returncode()
+    return completed
 
 
 def fix_issue_body(
@@ -90,6 +347,442 @@ def fix_comment_body(body, original_poster, original_url, original_org, original
     )
 
 
+class Transports:
+    """
+    Keep-alive connection pools, one per credential, shared by all threads.
+
+    Each pool keeps up to ``pool_size`` connections per host open between
+    requests. Connections do not survive forking: worker processes start with
+    no pool.
+    """
+
+    def __init__(self, pool_size: int = 10):
+        self.pool_size = pool_size
+        self._sessions: Dict[str, requests.Session] = {}
+        self._adapters: Dict[str, requests.adapters.HTTPAdapter] = {}
+        self._retries: Dict[str, Tuple[int, float]] = {}
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self.reset)
+
+    def get(self, credential: str) -> requests.Session:
+        with self._lock:
+            session = self._sessions.get(credential)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[credential] = session
+                self._adapters[credential] = adapter
+            return session
+
+    def send(
+        self,
+        credential: str,
+        method: str,
+        prepare: Callable[[], requests.PreparedRequest],
+        endpoint: Optional[str] = None,
+    ) -> requests.Response:
+        """
+        Send the request made by ``prepare`` with the pool of ``credential``.
+
+        The rate limit of the credential is waited for, and the request is
+        retried as long as it may succeed before the deadline of the job.
+        """
+        session = self.get(credential)
+        attempt = 0
+        while True:
+            _check_cancelled()
+            budgets.wait(credential, method, endpoint)
+            try:
+                response = session.send(prepare(), timeout=_timeout(method, endpoint))
+            except (requests.ConnectionError, requests.Timeout):
+                delay = _retry_delay(method, attempt, endpoint=endpoint)
+                if delay is None:
+                    raise
+            else:
+                budgets.record(credential, method, response, endpoint)
+                delay = _retry_delay(method, attempt, response, endpoint)
+                if delay is None:
+                    return response
+            attempt += 1
+            self.retried(credential, method, attempt, delay)
+            time.sleep(delay)
+
+    def retried(self, credential: str, method: str, attempt: int, delay: float) -> None:
+        print(yellow + f"{method} failed, retry {attempt}/{RETRIES} in {delay:.1f}s" + normal)
+        with self._lock:
+            retries, waited = self._retries.get(credential, (0, 0.0))
+            self._retries[credential] = (retries + 1, waited + delay)
+
+    def reset(self) -> None:
+        """Forget the pools, without closing connections the parent process uses."""
+        self._sessions = {}
+        self._adapters = {}
+        self._retries = {}
+        self._lock = threading.Lock()
+
+    def report(self) -> Dict[str, Tuple[int, float]]:
+        """Retries since the last report, for a worker to tell the bot process."""
+        with self._lock:
+            retries, self._retries = self._retries, {}
+        return retries
+
+    def merge(self, retries: Dict[str, Tuple[int, float]]) -> None:
+        """Count the retries reported by a worker."""
+        with self._lock:
+            for credential, (count, waited) in retries.items():
+                total, total_waited = self._retries.get(credential, (0, 0.0))
+                self._retries[credential] = (total + count, total_waited + waited)
+
+    def stats(self) -> dict:
+        """Requests made, connections opened and retries of each pool."""
+        stats: Dict[str, dict] = {}
+        with self._lock:
+            adapters = list(self._adapters.items())
+            retries = dict(self._retries)
+        for credential, adapter in adapters:
+            made = opened = 0
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                made += pool.num_requests
+                opened += pool.num_connections
+            stats[credential] = {"requests": made, "connections": opened, "reused": made - opened}
+        # the asynchronous session retries without a pool of ours.
+        for credential, (count, waited) in retries.items():
+            stats.setdefault(credential, {}).update(retries=count, retry_wait=waited)
+        return stats
+
+
+"""
+The connection pools used for all requests, sized by the ``http_pool_size`` option.
+"""
+transports = Transports()
+
+
+class RateBudget:
+    """What is left of the rate limit of a credential."""
+
+    def __init__(self):
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        self.reset = 0.0
+        self.blocked_until = 0.0
+        self.mutations: Deque[float] = deque()
+
+
+class RateBudgets:
+    """
+    Rate limits of each credential, as told by the headers of GitHub's responses.
+
+    Besides the hourly limit, GitHub has secondary limits on requests creating
+    content, and tells us to back off when we hit them. :meth:`delay` says how
+    long to wait before the next request not to get refused. Low priority work
+    leaves the last ``reserve`` of the hourly limit to the rest, and is deferred
+    rather than waiting more than ``defer_after`` seconds.
+    """
+
+    """
+    At most that many (seconds, requests) creating content, like comments and issues.
+    """
+    CONTENT_LIMITS = ((60, 80), (3600, 500))
+
+    def __init__(self, reserve: float = 0.2, defer_after: float = 30):
+        self.reserve = reserve
+        self.defer_after = defer_after
+        self._budgets: Dict[str, RateBudget] = {}
+        self._lock = threading.Lock()
+        self._reported_at = 0.0
+        # another thread may hold the lock while a worker is forked.
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def _budget(self, credential: str) -> RateBudget:
+        if credential not in self._budgets:
+            self._budgets[credential] = RateBudget()
+        return self._budgets[credential]
+
+    def record(
+        self,
+        credential: str,
+        method: str,
+        response: requests.Response,
+        endpoint: Optional[str] = None,
+    ) -> None:
+        headers = response.headers
+        now = time.time()
+        with self._lock:
+            budget = self._budget(credential)
+            if headers.get("X-RateLimit-Resource", "core") == "core":
+                if "X-RateLimit-Limit" in headers:
+                    budget.limit = int(headers["X-RateLimit-Limit"])
+                if "X-RateLimit-Remaining" in headers:
+                    budget.remaining = int(headers["X-RateLimit-Remaining"])
+                if "X-RateLimit-Reset" in headers:
+                    budget.reset = float(headers["X-RateLimit-Reset"])
+            if _mutates(method, endpoint):
+                budget.mutations.append(now)
+                while budget.mutations[0] < now - self.CONTENT_LIMITS[-1][0]:
+                    budget.mutations.popleft()
+            if response.status_code in (403, 429):
+                if "Retry-After" in headers:
+                    budget.blocked_until = now + float(headers["Retry-After"])
+                elif headers.get("X-RateLimit-Remaining") == "0":
+                    budget.blocked_until = budget.reset
+                elif "secondary rate limit" in response.text.lower():
+                    budget.blocked_until = now + 60
+                if budget.blocked_until > now:
+                    print(
+                        red + f"rate limited on {credential} until {budget.blocked_until}" + normal
+                    )
+
+    def delay(self, credential: str, method: str, endpoint: Optional[str] = None) -> float:
+        """
+        How long to wait before making a request.
+
+        Raise :class:`RateLimited` in low priority jobs that would have to wait
+        too long.
+        """
+        now = time.time()
+        low_priority = getattr(_local, "low_priority", False)
+        with self._lock:
+            budget = self._budget(credential)
+            until = budget.blocked_until
+            if budget.remaining is not None and budget.limit:
+                if budget.remaining == 0 or (
+                    low_priority and budget.remaining < budget.limit * self.reserve
+                ):
+                    until = max(until, budget.reset)
+            if _mutates(method, endpoint):
+                for window, limit in self.CONTENT_LIMITS:
+                    recent = [t for t in budget.mutations if t > now - window]
+                    if len(recent) >= limit:
+                        until = max(until, recent[-limit] + window)
+        delay = max(0.0, until - now)
+        if low_priority and delay > self.defer_after:
+            raise RateLimited(delay)
+        return delay
+
+    def wait(self, credential: str, method: str, endpoint: Optional[str] = None) -> None:
+        delay = self.delay(credential, method, endpoint)
+        left = _time_left()
+        if left is not None and delay > left:
+            raise DeadlineExceeded(f"rate limit of {credential} is back in {delay:.0f}s")
+        if delay:
+            print(yellow + f"waiting {delay:.0f}s for the rate limit of {credential}" + normal)
+            time.sleep(delay)
+
+    def report(self) -> dict:
+        """What a worker learned of the rate limits, for the bot process to :meth:`merge`."""
+        now = time.time()
+        with self._lock:
+            since, self._reported_at = self._reported_at, now
+            return {
+                credential: {
+                    "limit": budget.limit,
+                    "remaining": budget.remaining,
+                    "reset": budget.reset,
+                    "blocked_until": budget.blocked_until,
+                    "mutations": [t for t in budget.mutations if t > since],
+                }
+                for credential, budget in self._budgets.items()
+            }
+
+    def merge(self, report: dict) -> None:
+        """Take what a worker learned into account, the latest figures win."""
+        with self._lock:
+            for credential, reported in report.items():
+                budget = self._budget(credential)
+                if reported["reset"] > budget.reset or (
+                    reported["reset"] == budget.reset
+                    and reported["remaining"] is not None
+                    and (budget.remaining is None or reported["remaining"] < budget.remaining)
+                ):
+                    budget.limit = reported["limit"]
+                    budget.remaining = reported["remaining"]
+                    budget.reset = reported["reset"]
+                budget.blocked_until = max(budget.blocked_until, reported["blocked_until"])
+                budget.mutations = deque(sorted([*budget.mutations, *reported["mutations"]]))
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            return {
+                credential: {
+                    "limit": budget.limit,
+                    "remaining": budget.remaining,
+                    "reset_in": max(0, int(budget.reset - now)),
+                    "blocked_for": max(0, int(budget.blocked_until - now)),
+                    "content_last_minute": sum(t > now - 60 for t in budget.mutations),
+                }
+                for credential, budget in self._budgets.items()
+            }
+
+
+"""
+Rate limits of all the credentials used by the process.
+"""
+budgets = RateBudgets()
+
+
+class ResponseCache:
+    """
+    The last ``size`` responses to GET requests that had an ETag or a
+    Last-Modified date, least recently used first.
+
+    They are used to make requests conditional: GitHub answers ``304 Not
+    Modified`` when nothing changed, which does not count against the rate
+    limit, and we serve the response we had. Keys are to tell credentials,
+    URLs and media types apart.
+    """
+
+    def __init__(self, size: int = 1000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._responses: "OrderedDict[Hashable, requests.Response]" = OrderedDict()
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def get(self, key: Optional[Hashable]) -> Optional[requests.Response]:
+        """
+        The response we have for ``key``, to make the request conditional with
+        :meth:`validators` and then pass to :meth:`revalidated`.
+
+        It may be evicted in between, the 304 is answered with that one anyway.
+        """
+        if key is None:
+            return None
+        with self._lock:
+            return self._responses.get(key)
+
+    @staticmethod
+    def validators(cached: Optional[requests.Response]) -> Dict[str, str]:
+        """Headers making a request conditional on ``cached`` being up to date."""
+        if cached is None:
+            return {}
+        headers = {}
+        if "ETag" in cached.headers:
+            headers["If-None-Match"] = cached.headers["ETag"]
+        if "Last-Modified" in cached.headers:
+            headers["If-Modified-Since"] = cached.headers["Last-Modified"]
+        return headers
+
+    def revalidated(
+        self,
+        key: Optional[Hashable],
+        response: requests.Response,
+        cached: Optional[requests.Response] = None,
+    ) -> requests.Response:
+        """
+        The response to use for ``key``: ``cached`` if not modified, else ``response``.
+        """
+        if key is None:
+            return response
+        with self._lock:
+            if response.status_code == 304 and cached is not None:
+                self.hits += 1
+                self._store(key, cached)
+                cached = copy.copy(cached)
+                # the rate limit is the one of now.
+                cached.headers = CaseInsensitiveDict(cached.headers)
+                cached.headers.update(
+                    (k, v)
+                    for k, v in response.headers.items()
+                    if k.lower().startswith("x-ratelimit")
+                )
+                return cached
+            self.misses += 1
+            if response.status_code == 200 and (
+                "ETag" in response.headers or "Last-Modified" in response.headers
+            ):
+                self._store(key, response)
+        return response
+
+    def _store(self, key: Hashable, response: requests.Response) -> None:
+        self._responses[key] = response
+        self._responses.move_to_end(key)
+        if len(self._responses) > self.size:
+            self._responses.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._responses), "hits": self.hits, "misses": self.misses}
+
+
+"""
+Responses to GET requests of installations, sized by the ``response_cache`` option.
+"""
+responses = ResponseCache()
+
+
+class Tokens:
+    """
+    Access tokens with their expiry date, shared by all the sessions of the
+    process: the app JWT under ``"app"``, installation tokens under their ID.
+    """
+
+    def __init__(self):
+        self._tokens: Dict[str, Tuple[str, float]] = {}
+        self._refreshing: Set[str] = set()
+        self._lock = threading.Lock()
+        # each session makes one, a hook per instance would pile up.
+        _all_tokens.add(self)
+
+    def _after_fork(self) -> None:
+        # refreshing threads are not forked.
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        """The token and its expiry timestamp, if it is good for another minute."""
+        with self._lock:
+            entry = self._tokens.get(key)
+        if entry is None or entry[1] - 60 < time.time():
+            return None
+        return entry
+
+    def set(self, key: str, token: str, expires_at: float) -> None:
+        with self._lock:
+            self._tokens[key] = (token, expires_at)
+
+    def refresh(self, key: str, regen: Callable[[], None]) -> None:
+        """Call ``regen`` in a background thread, unless it is already running for ``key``."""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def target():
+            try:
+                regen()
+            except Exception:
+                print(red + f"failed to refresh token {key}" + normal)
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=target, name=f"token-{key}", daemon=True).start()
+
+
+_all_tokens: "weakref.WeakSet[Tokens]" = weakref.WeakSet()
+
+
+def _reset_tokens() -> None:
+    for tokens in list(_all_tokens):
+        tokens._after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_tokens)
+
+
 class Authenticator:
     def __init__(
         self,
@@ -100,28 +793,54 @@ class Authenticator:
     ):
         self.since = int(datetime.datetime.now().timestamp())
         self.duration = 60 * 10
-        self._token = None
+        self._token: Optional[str] = None
         self.integration_id = integration_id
         self.rsadata = rsadata
         self.personal_account_token = personal_account_token
         self.personal_account_name = personal_account_name
+        # org/repo -> installation, org -> installation, and installation -> org/repos,
+        # updated together by _map_repository and shared with sessions.
         self.idmap: Dict[str, str] = {}
         self._org_idmap: Dict[str, str] = {}
+        self._installation_repos: Dict[str, Set[str]] = {}
         self._session_class = Session
+        # to share the installation mapping and tokens with other processes.
+        self.store: Optional["JobStore"] = None
+        self.tokens = Tokens()
 
     def session(self, installation_id: str) -> "Session":
         """
         Given and installation id, return a session with the right credentials
         """
-        # print('spawning session for repo', [(k,v) for k,v in self.idmap.items() if v == installation_id])
-        # print('DEBUG: ', self.idmap, installation_id)
-        return self._session_class(
+        session = self._session_class(
             self.integration_id,
             self.rsadata,
             installation_id,
             self.personal_account_token,
             self.personal_account_name,
         )
+        session.store = self.store
+        session.tokens = self.tokens
+        session.idmap = self.idmap
+        session._org_idmap = self._org_idmap
+        session._installation_repos = self._installation_repos
+        return session
+
+    def _map_repository(self, org_repo: str, installation_id: str) -> None:
+        previous = self.idmap.get(org_repo)
+        if previous is not None and str(previous) != str(installation_id):
+            self._installation_repos.get(str(previous), set()).discard(org_repo)
+        self.idmap[org_repo] = installation_id
+        self._org_idmap[org_repo.split("/")[0]] = installation_id
+        self._installation_repos.setdefault(str(installation_id), set()).add(org_repo)
+
+    def repositories(self, installation_id: str) -> Set[str]:
+        """The org/repos of an installation we know of."""
+        return self._installation_repos.get(str(installation_id), set())
+
+    def async_session(self, installation_id: str) -> "AsyncSession":
+        """Same as :meth:`session`, but not blocking."""
+        return AsyncSession(self.session(installation_id))
 
     def get_session(self, org_repo):
         """Given an org and repo, return a session with the right credentials."""
@@ -129,6 +848,10 @@ class Authenticator:
         if org_repo in self.idmap:
             return self.session(self.idmap[org_repo])
 
+        # Maybe another process learned about it.
+        if self._load_idmap() and org_repo in self.idmap:
+            return self.session(self.idmap[org_repo])
+
         # Next try - see if this is a newly authorized repo in an
         # org that we've seen.
         org, _ = org_repo.split("/")
@@ -156,49 +879,68 @@ class Authenticator:
 
         return installations
 
-    def _build_auth_id_mapping(self):
+    def _build_auth_id_mapping(self, reuse=False):
         """
         Build an organisation/repo -> installation_id mappingg in order to be able
         to do cross repository operations.
+
+        With ``reuse``, a mapping another process built recently is used as is.
         """
         if not self.rsadata:
             print("Skipping auth_id_mapping build since there is no B64KEY set")
             return
+        if reuse and self._load_idmap():
+            print(green + f"Reusing mapping of {len(self.idmap)} repositories" + normal)
+            return
 
         self._installations = self.list_installations()
         for installation in self._installations:
             self._update_installation(installation)
 
+    def _load_idmap(self) -> bool:
+        """Get the mapping shared by other processes, return whether there was one."""
+        cached = self.store.cache_get("idmap") if self.store else None
+        if not cached:
+            return False
+        idmap, org_idmap = json.loads(cached)
+        for org_repo, installation_id in idmap.items():
+            self._map_repository(org_repo, installation_id)
+        self._org_idmap.update(org_idmap)
+        return True
+
+    def _save_idmap(self) -> None:
+        if not self.store:
+            return
+        cached = self.store.cache_get("idmap")
+        idmap, org_idmap = json.loads(cached) if cached else ({}, {})
+        idmap.update(self.idmap)
+        org_idmap.update(self._org_idmap)
+        self.store.cache_set("idmap", json.dumps([idmap, org_idmap]), IDMAP_TTL)
+
     def _update_installation(self, installation):
         print("Updating installations", installation)
         iid = installation["id"]
         print("... making a session", iid)
         session = self.session(iid)
         try:
-            # Make sure we get all pages.
-            url = installation["repositories_url"]
-            while True:
-                res = session.ghrequest("GET", url)
-                repositories = res.json()
-                for repo in repositories["repositories"]:
-                    print(
-                        "Mapping repo to installation:",
-                        repo["full_name"],
-                        repo["owner"]["login"],
-                        iid,
-                    )
-                    self.idmap[repo["full_name"]] = iid
-                    self._org_idmap[repo["owner"]["login"]] = iid
-                if "next" in res.links:
-                    url = res.links["next"]["url"]
-                    continue
-                break
-
+            for repo in session.paginate(installation["repositories_url"], key="repositories"):
+                print(
+                    "Mapping repo to installation:",
+                    repo["full_name"],
+                    repo["owner"]["login"],
+                    iid,
+                )
+                self._map_repository(repo["full_name"], iid)
         except Forbidden:
             print("Forbidden for", iid)
             return
+        self._save_idmap()
 
-    def _integration_authenticated_request(self, method, url, json=None):
+    def _app_token(self) -> str:
+        """The JWT authenticating as the app, signed again only when it expires."""
+        cached = self.tokens.get("app")
+        if cached:
+            return cached[0]
         self.since = int(datetime.datetime.now().timestamp())
         payload = dict(
             {
@@ -210,7 +952,11 @@ class Authenticator:
 
         assert self.rsadata is not None
         tok = jwt.encode(payload, key=self.rsadata, algorithm="RS256")
+        self.tokens.set("app", tok, self.since + self.duration)
+        return tok
 
+    def _integration_authenticated_request(self, method, url, json=None):
+        tok = self._app_token()
         headers = {
             "Authorization": f"Bearer {tok}",
             "Accept": ACCEPT_HEADER_V3,
@@ -219,8 +965,7 @@ class Authenticator:
         }
         req = requests.Request(method, url, headers=headers, json=json)
         prepared = req.prepare()
-        with requests.Session() as s:
-            return s.send(prepared)  # type:ignore[attr-defined]
+        return transports.send("app", method, lambda: prepared, endpoint="token")
 
 
 class Forbidden(Exception):
@@ -240,11 +985,29 @@ class Session(Authenticator):
         self.installation_id = installation_id
 
     def token(self) -> str:
-        now = datetime.datetime.now().timestamp()
-        if (now > self.since + self.duration - 60) or (self._token is None):
+        """
+        Installation token, shared with other sessions and processes.
+
+        Only the first call for an installation waits for GitHub, tokens about
+        to expire are refreshed in the background while still being used.
+        """
+        key = str(self.installation_id)
+        cached = self.tokens.get(key)
+        if cached is None and self.store:
+            # a token another process got recently is good for a while.
+            shared = self.store.cache_get(f"installation-token:{key}")
+            if shared:
+                cached = tuple(json.loads(shared))
+                self.tokens.set(key, *cached)
+        if cached is None:
             self.regen_token()
-        assert self._token is not None
-        return self._token
+            assert self._token is not None
+            return self._token
+        token, expires_at = cached
+        if expires_at - time.time() < TOKEN_REFRESH:
+            self.tokens.refresh(key, self.regen_token)
+        self._token = token
+        return token
 
     def regen_token(self) -> None:
         method = "POST"
@@ -254,9 +1017,21 @@ class Session(Authenticator):
             raise Forbidden(self.installation_id)
 
         try:
-            self._token = json.loads(resp.content.decode())["token"]
+            data = json.loads(resp.content.decode())
+            self._token = data["token"]
+            expires_at = datetime.datetime.strptime(
+                data["expires_at"], "%Y-%m-%dT%H:%M:%SZ"
+            ).replace(tzinfo=datetime.timezone.utc)
         except Exception:
             raise ValueError(resp.content, url)
+        key = str(self.installation_id)
+        self.tokens.set(key, self._token, expires_at.timestamp())
+        if self.store:
+            self.store.cache_set(
+                f"installation-token:{key}",
+                json.dumps([self._token, expires_at.timestamp()]),
+                expires_at.timestamp() - time.time() - 60,
+            )
 
     def personal_request(
         self,
@@ -280,14 +1055,13 @@ class Session(Authenticator):
             req = requests.Request(method, url, headers=headers, json=json)
             return req.prepare()
 
-        with requests.Session() as s:
-            response = s.send(prepare())  # type:ignore[attr-defined]
-            if response.status_code == 401:
-                self.regen_token()
-                response = s.send(prepare())  # type:ignore[attr-defined]
-            if raise_for_status:
-                response.raise_for_status()
-            return response  # type:ignore[no-any-return]
+        response = transports.send("personal", method, prepare)
+        if response.status_code == 401:
+            self.regen_token()
+            response = transports.send("personal", method, prepare)
+        if raise_for_status:
+            response.raise_for_status()
+        return response  # type:ignore[no-any-return]
 
     def ghrequest(
         self,
@@ -297,10 +1071,19 @@ class Session(Authenticator):
         *,
         override_accept_header: Optional[str] = None,
         raise_for_status: Optional[bool] = True,
+        endpoint: Optional[str] = None,
     ) -> requests.Response:
+        """
+        Make a request to the GitHub API as the installation.
+
+        ``endpoint`` is the class of :data:`TIMEOUTS` of the request, when its
+        method does not tell, e.g. "read" for a GraphQL query.
+        """
         accept = ACCEPT_HEADER
         if override_accept_header:
             accept = override_accept_header
+        key = (self.installation_id, accept, url) if method == "GET" else None
+        cached = responses.get(key)
 
         def prepare():
             atk = self.token()
@@ -309,40 +1092,63 @@ class Session(Authenticator):
                 "Accept": accept,
                 "Host": "api.github.com",
                 "User-Agent": "python/requests",
+                **responses.validators(cached),
             }
             print(f"Making a {method} call to {url}")
             req = requests.Request(method, url, headers=headers, json=json)
             return req.prepare()
 
-        with requests.Session() as s:
-            response = s.send(prepare())  # type:ignore[attr-defined]
-            if response.status_code == 401:
-                print("Unauthorized, regen token")
-                self.regen_token()
-                response = s.send(prepare())  # type:ignore[attr-defined]
-            if raise_for_status:
-                response.raise_for_status()
-            rate_limit = response.headers.get("X-RateLimit-Limit", -1)
-            rate_remaining = response.headers.get("X-RateLimit-Limit", -1)
-            if rate_limit:
-                repo_name_list = [k for k, v in self.idmap.items() if v == self.installation_id]
-                repo_name = "no-repo"
-                if len(repo_name_list) == 1:
-                    repo_name = repo_name_list[0]
-                elif len(repo_name_list) == 0:
-                    repo_name = "no-matches"
-                else:
-                    repo_name = "multiple-matches"
-
-                add_event(
-                    "gh-rate",
-                    {
-                        "limit": int(rate_limit),
-                        "rate_remaining": int(rate_remaining),
-                        "installation": repo_name,
-                    },
-                )
-            return response  # type:ignore[no-any-return]
+        credential = f"installation:{self.installation_id}"
+        response = transports.send(credential, method, prepare, endpoint)
+        if response.status_code == 401:
+            print("Unauthorized, regen token")
+            self.regen_token()
+            response = transports.send(credential, method, prepare, endpoint)
+        self._report_rate(response)
+        response = responses.revalidated(key, response, cached)
+        if raise_for_status:
+            response.raise_for_status()
+        return response  # type:ignore[no-any-return]
+
+    def paginate(
+        self, url: str, *, override_accept_header: Optional[str] = None, key: Optional[str] = None
+    ) -> Iterator[Any]:
+        """
+        Yield the items of a list endpoint, fetching pages of 100 as they are consumed.
+
+        ``key`` is the field holding the items, for endpoints returning an object.
+        """
+        parts = urlsplit(url)
+        query = dict(parse_qsl(parts.query))
+        query.setdefault("per_page", "100")
+        next_url: Optional[str] = urlunsplit(parts._replace(query=urlencode(query)))
+        while next_url:
+            response = self.ghrequest(
+                "GET", next_url, override_accept_header=override_accept_header
+            )
+            items = response.json()
+            yield from items[key] if key else items
+            next_url = response.links.get("next", {}).get("url")
+
+    def _report_rate(self, response: requests.Response) -> None:
+        rate_limit = response.headers.get("X-RateLimit-Limit")
+        rate_remaining = response.headers.get("X-RateLimit-Remaining")
+        if rate_limit and rate_remaining:
+            repositories = self.repositories(self.installation_id)
+            repo_name = "no-matches"
+            if len(repositories) == 1:
+                repo_name = next(iter(repositories))
+            elif repositories:
+                repo_name = "multiple-matches"
+            add_event(
+                "gh-rate",
+                {
+                    "limit": int(rate_limit),
+                    "rate_remaining": int(rate_remaining),
+                    "installation": self.installation_id,
+                    "repository": repo_name,
+                },
+            )
 
     def _get_permission(self, org: str, repo: str, username: str) -> Permission:
         get_collaborators_query = API_COLLABORATORS_TEMPLATE.format(
@@ -376,12 +1182,7 @@ class Session(Authenticator):
         get_collaborators_query = "https://api.github.com/repos/{org}/{repo}/collaborators".format(
             org=org, repo=repo
         )
-        resp = self.ghrequest("GET", get_collaborators_query, None)
-        if resp.status_code == 200:
-            return resp.json()
-        else:
-            resp.raise_for_status()
-            return None
+        return list(self.paginate(get_collaborators_query))
 
     def create_issue(
         self,
@@ -393,24 +1194,184 @@ class Session(Authenticator):
         labels: Optional[list] = None,
         assignees: Optional[list] = None,
     ) -> requests.Response:
-        arguments: dict = {"title": title, "body": body}
+        return self.ghrequest(
+            "POST",
+            f"https://api.github.com/repos/{org}/{repo}/issues",
+            json=_issue_arguments(title, body, labels, assignees),
+        )
 
-        if labels:
-            if type(labels) in (list, tuple):
-                arguments["labels"] = labels
-            else:
-                raise ValueError("Labels must be a list of a tuple")
 
-        if assignees:
-            if type(assignees) in (list, tuple):
-                arguments["assignees"] = assignees
+def _issue_arguments(
+    title: str, body: str, labels: Optional[list], assignees: Optional[list]
+) -> dict:
+    arguments: dict = {"title": title, "body": body}
+
+    if labels:
+        if type(labels) in (list, tuple):
+            arguments["labels"] = labels
+        else:
+            raise ValueError("Labels must be a list of a tuple")
+
+    if assignees:
+        if type(assignees) in (list, tuple):
+            arguments["assignees"] = assignees
+        else:
+            raise ValueError("Assignees must be a list or a tuple")
+    return arguments
+
+
+class AsyncSession:
+    """
+    Non blocking counterpart of :class:`Session`, so that independent calls
+    can be made at once::
+
+        labels = await asyncio.gather(*(session.ghrequest("GET", url) for url in urls))
+
+    Responses are :class:`requests.Response`, like those of :class:`Session`
+    which provides the tokens.
+    """
+
+    def __init__(self, session: Session):
+        self.session = session
+
+    async def token(self) -> str:
+        if self.session.tokens.get(str(self.session.installation_id)):
+            return self.session.token()
+        # first token of the installation, that's a blocking request.
+        return await asyncio.get_running_loop().run_in_executor(None, self.session.token)
+
+    async def ghrequest(
+        self,
+        method: str,
+        url: str,
+        json: Optional[dict] = None,
+        *,
+        override_accept_header: Optional[str] = None,
+        raise_for_status: Optional[bool] = True,
+        endpoint: Optional[str] = None,
+    ) -> requests.Response:
+        accept = override_accept_header or ACCEPT_HEADER
+        key = (self.session.installation_id, accept, url) if method == "GET" else None
+        cached = responses.get(key)
+        validators = responses.validators(cached)
+        response = await self._send(method, url, json, accept, validators, endpoint)
+        if response.status_code == 401:
+            print("Unauthorized, regen token")
+            await asyncio.get_running_loop().run_in_executor(None, self.session.regen_token)
+            response = await self._send(method, url, json, accept, validators, endpoint)
+        self.session._report_rate(response)
+        response = responses.revalidated(key, response, cached)
+        if raise_for_status:
+            response.raise_for_status()
+        return response
+
+    async def _send(
+        self,
+        method: str,
+        url: str,
+        json: Optional[dict],
+        accept: str,
+        extra: Dict[str, str],
+        endpoint: Optional[str] = None,
+    ) -> requests.Response:
+        """Same as :meth:`Transports.send`."""
+        credential = f"installation:{self.session.installation_id}"
+        attempt = 0
+        while True:
+            _check_cancelled()
+            delay = budgets.delay(credential, method, endpoint)
+            left = _time_left()
+            if left is not None and delay > left:
+                raise DeadlineExceeded(f"rate limit of {credential} is back in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            try:
+                response = await self._fetch(method, url, json, accept, extra, endpoint)
+            except (OSError, HTTPClientError):
+                retry = _retry_delay(method, attempt, endpoint=endpoint)
+                if retry is None:
+                    raise
             else:
-                raise ValueError("Assignees must be a list or a tuple")
+                budgets.record(credential, method, response, endpoint)
+                retry = _retry_delay(method, attempt, response, endpoint)
+                if retry is None:
+                    return response
+            attempt += 1
+            transports.retried(credential, method, attempt, retry)
+            await asyncio.sleep(retry)
 
-        return self.ghrequest(
+    async def _fetch(
+        self,
+        method: str,
+        url: str,
+        json: Optional[dict],
+        accept: str,
+        extra: Dict[str, str],
+        endpoint: Optional[str] = None,
+    ) -> requests.Response:
+        headers = {
+            "Authorization": f"Bearer {await self.token()}",
+            "Accept": accept,
+            "Host": "api.github.com",
+            "User-Agent": "python/requests",
+            **extra,
+        }
+        print(f"Making a {method} call to {url}")
+        # let requests encode the body, as the blocking session does.
+        prepared = requests.Request(method, url, headers=headers, json=json).prepare()
+        connect_timeout, request_timeout = _timeout(method, endpoint)
+        res = await AsyncHTTPClient().fetch(
+            url,
+            method=method,
+            headers=dict(prepared.headers),
+            body=prepared.body,
+            connect_timeout=connect_timeout,
+            request_timeout=request_timeout,
+            raise_error=False,
+            allow_nonstandard_methods=True,
+        )
+        response = requests.Response()
+        response.status_code = res.code
+        response.reason = res.reason
+        response.url = res.effective_url
+        response.headers = CaseInsensitiveDict(res.headers)
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = res.body or b""
+        return response
+
+    async def paginate(
+        self, url: str, *, override_accept_header: Optional[str] = None, key: Optional[str] = None
+    ) -> AsyncIterator[Any]:
+        """Same as :meth:`Session.paginate`."""
+        parts = urlsplit(url)
+        query = dict(parse_qsl(parts.query))
+        query.setdefault("per_page", "100")
+        next_url: Optional[str] = urlunsplit(parts._replace(query=urlencode(query)))
+        while next_url:
+            response = await self.ghrequest(
+                "GET", next_url, override_accept_header=override_accept_header
+            )
+            items = response.json()
+            for item in items[key] if key else items:
+                yield item
+            next_url = response.links.get("next", {}).get("url")
+
+    async def post_comment(self, comment_url: str, body: str) -> None:
+        await self.ghrequest("POST", comment_url, json={"body": body})
+
+    async def create_issue(
+        self,
+        org: str,
+        repo: str,
+        title: str,
+        body: str,
+        *,
+        labels: Optional[list] = None,
+        assignees: Optional[list] = None,
+    ) -> requests.Response:
+        return await self.ghrequest(
             "POST",
             f"https://api.github.com/repos/{org}/{repo}/issues",
-            json=arguments,
+            json=_issue_arguments(title, body, labels, assignees),
         )
 
 
@@ -0,0 +1,349 @@
+"""
+Worker processes running heavy commands.
+
+Heavy commands leave things behind in the process running them: GitPython
+keeps ``git cat-file`` children around, and ``black`` stays imported once a
+suggestion was computed. They are run in worker processes forked from the bot
+instead, which are retired after a number of jobs or once they use too much
+memory. Git processes they leave behind are killed along with them.
+
+A job run in a worker is still scheduled, journaled and cancelled from the
+bot process. The worker reports the commit the job works on as soon as it is
+known, so that it can be superseded (see :meth:`.jobs.JobQueue.supersede`),
+and its checkpoints, for the bot process to release it with its progress.
+
+Busy workers ignore SIGTERM: process managers send it to every process, and
+it is for the bot process to let the job finish or to give up on it, then stop
+them. Idle workers just exit.
+"""
+import gc
+import multiprocessing
+import os
+import resource
+import signal
+import sys
+import threading
+import traceback
+from typing import Callable, List, Optional
+
+from .jobs import Job
+from .store import JobStore
+from .utils import Cancelled, RateLimited, add_event, set_cancel_token
+
+green = "\033[0;32m"
+yellow = "\033[0;33m"
+red = "\033[0;31m"
+normal = "\033[0m"
+
+_fork = multiprocessing.get_context("fork")
+
+
+class _WorkerJob(Job):
+    """A job running in a worker, telling the bot process about its head and phases."""
+
+    conn = None
+
+    @property
+    def head(self) -> Optional[str]:
+        return self._head
+
+    @head.setter
+    def head(self, value: Optional[str]) -> None:
+        self._head = value
+        if value is not None and self.conn is not None:
+            self.conn.send(("head", value))
+
+    def checkpoint(self, phase: str, workspace: Optional[str] = None) -> None:
+        super().checkpoint(phase, workspace)
+        if self.conn is not None:
+            self.conn.send(("checkpoint", (self.phases, self.workspace)))
+
+
+def _rss() -> int:
+    """Peak resident memory of the current process, in MiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+
+def _reap() -> None:
+    """Close the git processes of dropped ``git.Repo`` and collect exited children."""
+    gc.collect()
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0]:
+            pass
+    except ChildProcessError:
+        pass
+
+
+def _serve(conn, runner, store_path, initializer, report):
+    parent = os.getppid()
+    # own group, for the git processes left behind to be killed with us.
+    os.setpgid(0, 0)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    store = JobStore(store_path)
+    if initializer:
+        initializer(store)
+    current: List[Job] = []
+
+    def terminate(sig, frame):
+        if not current:
+            sys.exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    def cancel(sig, frame):
+        # not from the handler, it may interrupt a thread holding the token lock.
+        for job in current:
+            threading.Thread(target=job.token.cancel).start()
+
+    signal.signal(signal.SIGUSR1, cancel)
+    done = 0
+    while True:
+        # other workers hold the bot end of our pipe too, we never get EOF.
+        if not conn.poll(5):
+            if os.getppid() != parent:
+                return
+            continue
+        spec = conn.recv()
+        if spec is None:
+            return
+        job = _WorkerJob(
+            spec["kind"],
+            spec["payload"],
+            user=spec["user"],
+            command=spec["command"],
+            arguments=spec["arguments"],
+            delivery=spec["delivery"],
+            lane=spec["lane"],
+        )
+        job.id = spec["id"]
+        job.status = "running"
+        job.queued_at = spec["queued_at"]
+        job.started_at = spec["started_at"]
+        job.phases = spec["phases"]
+        job.workspace = spec["workspace"]
+        job.head = spec["head"]
+        job.context.checkout = spec["checkout"]
+        job.conn = conn
+        job._store = store
+        current.append(job)
+        set_cancel_token(job.token)
+        delay = 0.0
+        try:
+            job.token.check()
+            runner(job)
+            status = "done"
+        except RateLimited as e:
+            status = "deferred"
+            delay = e.delay
+        except Cancelled:
+            status = "cancelled"
+        except Exception:
+            status = "failed"
+            print(red + f"{job} crashed in worker {os.getpid()}" + normal)
+            traceback.print_exc()
+        finally:
+            set_cancel_token(None)
+            current.clear()
+        _reap()
+        done += 1
+        conn.send(
+            (
+                "result",
+                {
+                    "status": status,
+                    "phases": job.phases,
+                    "workspace": job.workspace,
+                    "head": job.head,
+                    "refused": job.refused,
+                    "checkout": job.context.checkout,
+                    "jobs": done,
+                    "rss": _rss(),
+                    "delay": delay,
+                    "report": report() if report else None,
+                },
+            )
+        )
+
+
+class Worker:
+    """A worker process and its pipe."""
+
+    def __init__(self, runner, store_path, initializer=None, report=None):
+        self.conn, child = _fork.Pipe()
+        self.process = _fork.Process(
+            target=_serve, args=(child, runner, store_path, initializer, report), daemon=True
+        )
+        self.process.start()
+        child.close()
+        self.jobs = 0
+        self.rss = 0
+        # figures of the last job, see WorkerPool.
+        self.report: Optional[dict] = None
+        print(green + f"started worker {self.pid}" + normal)
+
+    @property
+    def pid(self) -> int:
+        assert self.process.pid is not None
+        return self.process.pid
+
+    def run(self, job: Job) -> None:
+        """Run ``job`` in the worker, raise :class:`.utils.Cancelled` if it was."""
+        job.token.check()
+        self.conn.send(
+            {
+                "id": job.id,
+                "kind": job.kind,
+                "payload": job.payload,
+                "user": job.user,
+                "command": job.command,
+                "arguments": job.arguments,
+                "delivery": job.delivery,
+                "lane": job.lane,
+                "queued_at": job.queued_at,
+                "started_at": job.started_at,
+                "phases": job.phases,
+                "workspace": job.workspace,
+                "head": job.head,
+                "checkout": job.context.checkout,
+            }
+        )
+        signalled = False
+        while True:
+            if not self.conn.poll(1):
+                if job.token.cancelled and not signalled:
+                    os.kill(self.pid, signal.SIGUSR1)
+                    signalled = True
+                continue
+            kind, value = self.conn.recv()
+            if kind == "head":
+                job.head = value
+                continue
+            if kind == "checkpoint":
+                job.phases, job.workspace = value
+                continue
+            break
+        job.phases = value["phases"]
+        job.workspace = value["workspace"]
+        job.head = value["head"]
+        job.refused = value["refused"]
+        job.context.checkout = value["checkout"]
+        # the worker may have pushed to the PR we have data of.
+        job.context.forget_pull_requests()
+        self.jobs = value["jobs"]
+        self.rss = value["rss"]
+        self.report = value["report"]
+        if value["status"] == "cancelled":
+            raise Cancelled()
+        if value["status"] == "deferred":
+            raise RateLimited(value["delay"])
+        if value["status"] == "failed":
+            raise RuntimeError(f"{job} failed in worker {self.pid}")
+
+    def stop(self, timeout: float = 10) -> None:
+        """Let the worker exit, and kill the processes it left behind."""
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.conn.close()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+            print(yellow + f"killed processes left by worker {self.pid}" + normal)
+        except ProcessLookupError:
+            pass
+
+
+class WorkerPool:
+    """
+    Run jobs with ``runner`` in worker processes, one job at a time per worker.
+
+    Workers are started as needed, and retired after ``max_jobs`` jobs or once
+    they used ``max_rss`` MiB of memory, 0 meaning no limit. ``initializer``
+    is called in each new worker with the store it journals to.
+
+    Metrics gathered in workers would be lost: ``report`` is called in the
+    worker after each job, and ``merge`` with what it returned in this process.
+    """
+
+    def __init__(
+        self,
+        runner: Callable[[Job], None],
+        store_path: str,
+        max_jobs: int = 0,
+        max_rss: int = 0,
+        initializer: Optional[Callable[[JobStore], None]] = None,
+        report: Optional[Callable[[], dict]] = None,
+        merge: Optional[Callable[[dict], None]] = None,
+    ):
+        self.runner = runner
+        self.store_path = store_path
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.initializer = initializer
+        self.report = report
+        self.merge = merge
+        self.retired = 0
+        self._idle: List[Worker] = []
+        self._busy: List[Worker] = []
+        self._lock = threading.Lock()
+
+    def run(self, job: Job) -> None:
+        with self._lock:
+            if self._idle:
+                worker = self._idle.pop()
+            else:
+                worker = Worker(self.runner, self.store_path, self.initializer, self.report)
+            self._busy.append(worker)
+        reason = None
+        try:
+            worker.run(job)
+        except (EOFError, OSError):
+            reason = "died"
+            raise RuntimeError(f"worker {worker.pid} died running {job}")
+        finally:
+            if worker.report is not None and self.merge:
+                self.merge(worker.report)
+                worker.report = None
+            if reason is None and self.max_jobs and worker.jobs >= self.max_jobs:
+                reason = f"ran {worker.jobs} jobs"
+            if reason is None and self.max_rss and worker.rss >= self.max_rss:
+                reason = f"uses {worker.rss} MiB"
+            with self._lock:
+                self._busy.remove(worker)
+                if reason is None:
+                    self._idle.append(worker)
+                else:
+                    self.retired += 1
+            if reason is not None:
+                self.retire(worker, reason)
+
+    def retire(self, worker: Worker, reason: str) -> None:
+        print(yellow + f"retiring worker {worker.pid}: {reason}" + normal)
+        add_event("worker", {"retired": reason, "jobs": worker.jobs, "rss": worker.rss})
+        worker.stop()
+
+    def stop(self) -> None:
+        """
+        Stop all workers, killing the busy ones: their jobs were released, or
+        they fail as interrupted and stay queued.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+            busy = list(self._busy)
+        for worker in idle:
+            worker.stop()
+        for worker in busy:
+            worker.stop(timeout=0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            workers = [*self._busy, *self._idle]
+            return {
+                "workers": [{"pid": w.pid, "jobs": w.jobs, "rss": w.rss} for w in workers],
+                "retired": self.retired,
+            }
@@ -0,0 +1,81 @@
+from unittest import mock
+
+from ..meeseeksbox.context import CommentContext
+from ..meeseeksbox.scopes import Permission
+
+PAYLOAD = {
+    "repository": {"owner": {"login": "org"}, "name": "repo"},
+    "issue": {"number": 12},
+}
+
+DATA = {
+    "repository": {
+        "nameWithOwner": "org/repo",
+        "defaultBranchRef": {"name": "main"},
+        "config": {"text": "users:\n  alice:\n    can: [backport]\n"},
+        "collaborators": {
+            "edges": [
+                {"permission": "READ", "node": {"login": "alice2"}},
+                {"permission": "MAINTAIN", "node": {"login": "Alice"}},
+            ]
+        },
+        "issueOrPullRequest": {
+            "maintainerCanModify": True,
+            "headRepository": {"nameWithOwner": "alice/repo"},
+            "headRepositoryOwner": {"login": "alice"},
+        },
+    }
+}
+
+
+def test_details_are_loaded_in_one_query():
+    session = mock.Mock()
+    session.ghrequest.return_value.json.return_value = {"data": DATA}
+    context = CommentContext()
+
+    details = context.details(session, PAYLOAD, "alice")
+    assert details is context.details(session, PAYLOAD, "alice")
+    assert session.ghrequest.call_count == 1
+    assert details is not None
+    assert details.permission == Permission.write
+    assert details.config == {"users": {"alice": {"can": ["backport"]}}}
+    assert (details.head_repo, details.head_user, details.maintainer_can_modify) == (
+        "alice/repo",
+        "alice",
+        True,
+    )
+    assert context.default_branch(session, "org", "repo") == "main"
+    assert session.ghrequest.call_count == 1
+
+
+def test_rest_is_used_when_query_fails():
+    session = mock.Mock()
+    session.ghrequest.return_value.json.return_value = {"data": None, "errors": ["nope"]}
+    context = CommentContext()
+
+    assert context.details(session, PAYLOAD, "alice") is None
+    assert context.details(session, PAYLOAD, "alice") is None
+    assert session.ghrequest.call_count == 1
+    session.ghrequest.return_value.json.return_value = {"default_branch": "master"}
+    assert context.default_branch(session, "org", "repo") == "master"
+
+
+def test_pull_request_data_is_fetched_once_until_pushed_to():
+    session = mock.Mock()
+    session.paginate.side_effect = lambda url: iter([{"url": url}])
+    session.ghrequest.return_value.json.return_value = {"default_branch": "main"}
+    context = CommentContext()
+    url = "https://api.github.com/repos/org/repo/pulls/12"
+
+    for _ in range(2):
+        assert context.commits(session, url) == [{"url": url + "/commits"}]
+        assert context.files(session, url) == [{"url": url + "/files"}]
+        assert context.default_branch(session, "org", "repo") == "main"
+    assert session.paginate.call_count == 2
+    assert session.ghrequest.call_count == 1
+
+    context.forget_pull_requests()
+    context.commits(session, url)
+    context.default_branch(session, "org", "repo")
+    assert session.paginate.call_count == 3
+    assert session.ghrequest.call_count == 1
@@ -0,0 +1,282 @@
+import threading
+import time
+from unittest import mock
+
+import git
+
+from ..meeseeksbox.admission import Admission, Limits
+from ..meeseeksbox.context import CommentContext
+from ..meeseeksbox.jobs import Job, JobQueue
+from ..meeseeksbox.utils import RateLimited, run
+
+
+def test_queue_runs_jobs():
+    ran = []
+    done = threading.Event()
+
+    def runner(job):
+        ran.append(job.command)
+        if len(ran) == 2:
+            done.set()
+
+    queue = JobQueue(runner, workers={"light": 2})
+    queue.start()
+    queue.submit(Job("command", {}, command="hello"))
+    queue.submit(Job("command", {}, command="zen"))
+    assert done.wait(5)
+    assert sorted(ran) == ["hello", "zen"]
+
+
+def test_failing_job_does_not_kill_worker():
+    done = threading.Event()
+
+    def runner(job):
+        if job.command == "boom":
+            raise ValueError(job)
+        done.set()
+
+    queue = JobQueue(runner)
+    queue.start()
+    queue.submit(Job("command", {}, command="boom"))
+    queue.submit(Job("command", {}, command="hello"))
+    assert done.wait(5)
+    stats = queue.stats()
+    assert stats["failed"] == 1
+    assert "latency" in stats["lanes"]["light"]
+
+
+def test_light_jobs_do_not_wait_behind_heavy_ones():
+    release = threading.Event()
+    started = threading.Event()
+    done = threading.Event()
+
+    def runner(job):
+        if job.lane == "heavy":
+            started.set()
+            release.wait(5)
+        else:
+            done.set()
+
+    queue = JobQueue(runner, workers={"light": 1, "heavy": 1})
+    queue.start()
+    queue.submit(Job("command", {}, command="backport", lane="heavy"))
+    queue.submit(Job("command", {}, command="backport", lane="heavy"))
+    queue.submit(Job("command", {}, command="tag", lane="light"))
+    assert done.wait(5) and started.wait(5)
+    stats = queue.stats()["lanes"]
+    assert stats["heavy"]["running"] == 1
+    assert stats["heavy"]["pending"] == 1
+    release.set()
+
+
+def _job(org, repo, installation):
+    payload = {
+        "installation": {"id": installation},
+        "repository": {"name": repo, "full_name": f"{org}/{repo}", "owner": {"login": org}},
+    }
+    return Job("command", payload, command="backport", lane="heavy")
+
+
+def test_installations_are_served_in_turn():
+    queue = JobQueue(lambda job: None, workers={"heavy": 1})
+    for i in range(3):
+        queue.submit(_job("pandas-dev", f"repo{i}", 1))
+    queue.submit(_job("matplotlib", "matplotlib", 2))
+    assert queue.stats()["lanes"]["heavy"]["pending_by_org"] == {"pandas-dev": 3, "matplotlib": 1}
+
+    order = []
+    for _ in range(4):
+        job = queue._next("heavy")
+        assert job is not None
+        order.append(job.org)
+        queue._running.discard(job)
+    assert order == ["pandas-dev", "matplotlib", "pandas-dev", "pandas-dev"]
+
+
+def test_repo_limit():
+    queue = JobQueue(lambda job: None, workers={"heavy": 2}, repo_limits={"heavy": 1})
+    queue.submit(_job("matplotlib", "matplotlib", 1))
+    # same checkout directory, even if from another org.
+    queue.submit(_job("someone", "matplotlib", 2))
+    queue.submit(_job("matplotlib", "mpl-sandbox", 1))
+    first = queue._next("heavy")
+    second = queue._next("heavy")
+    assert first is not None and second is not None
+    assert first.repo == "matplotlib/matplotlib"
+    assert second.repo == "matplotlib/mpl-sandbox"
+    assert queue._select("heavy") is None
+    queue._running.discard(first)
+    third = queue._select("heavy")
+    assert third is not None and third.repo == "someone/matplotlib"
+
+
+def test_admission_throttles_and_sheds():
+    queue = JobQueue(lambda job: None, workers={"light": 1, "heavy": 1})
+    limits: Limits = {"user": {"light": (1, 2)}}
+    admission = Admission(queue, shed_threshold=1, limits=limits)
+    hello = Job("command", {}, user="someone", command="hello")
+    assert admission.admit(hello) is None
+    assert admission.admit(hello) is None
+    assert admission.admit(hello) == "throttled"
+    assert admission.admit(Job("command", {}, user="other", command="hello")) is None
+
+    for i in range(2):
+        queue.submit(_job("org", f"repo{i}", 1))
+    assert admission.admit(Job("command", {}, user="other", command="zen"), True) == "shed"
+    assert admission.counts == {"admitted": 3, "throttled": 1, "shed": 1}
+    assert admission.should_notify("other")
+    assert not admission.should_notify("other")
+
+
+def test_cancel_pending_and_running_jobs():
+    started = threading.Event()
+
+    def runner(job):
+        started.set()
+        run("sleep 30")
+
+    queue = JobQueue(runner, workers={"heavy": 1})
+    queue.start()
+    running = queue.submit(_pr_job("backport", "to 3.x"))
+    pending = queue.submit(_pr_job("backport", "to 2.x"))
+    other = queue.submit(_pr_job("precommit", None))
+    assert started.wait(5)
+
+    assert queue.cancel("org/repo", 1, "backport", "to 2.x") == [pending]
+    assert pending.status == "cancelled"
+    assert queue.cancel("org/repo", 2) == []
+    assert queue.cancel("org/repo", 1, "precommit") == [other]
+    assert queue.cancel("org/repo", 1) == [running]
+    assert queue.drain(5)
+    assert running.status == "cancelled"
+    assert queue.stats()["cancelled"] == 3
+
+
+def test_cancel_kills_git_processes_of_gitpython():
+    started = threading.Event()
+
+    def runner(job):
+        started.set()
+        try:
+            git.Git().execute(["sleep", "30"])
+        except git.GitCommandError:
+            pass
+
+    queue = JobQueue(runner, workers={"heavy": 1})
+    queue.start()
+    job = queue.submit(_pr_job("backport", "to 3.x"))
+    assert started.wait(5)
+    time.sleep(0.2)
+    assert queue.cancel("org/repo", 1) == [job]
+    assert queue.drain(5)
+    assert job.status == "cancelled"
+
+
+def test_supersede_restarts_jobs_on_new_head():
+    heads = ["old", "new"]
+    started = threading.Event()
+    done = threading.Event()
+
+    def runner(job):
+        job.head = heads.pop(0)
+        if job.head == "old":
+            started.set()
+            run("sleep 30")
+        done.set()
+
+    queue = JobQueue(runner, workers={"heavy": 1})
+    queue.start()
+    job = queue.submit(_pr_job("precommit", None))
+    assert started.wait(5)
+    assert queue.supersede("org/repo", 1, "old", {"precommit"}) == []
+    assert queue.supersede("org/repo", 1, "new", {"backport"}) == []
+    assert queue.supersede("org/repo", 1, "new", {"precommit"}) == [job]
+    assert done.wait(5)
+    assert job.status == "superseded"
+    assert queue.drain(5)
+    assert queue.stats()["superseded"] == 1
+    assert queue.stats()["done"] == 1
+
+
+def test_rate_limited_jobs_run_later():
+    attempts = []
+    done = threading.Event()
+
+    def runner(job):
+        attempts.append(time.time())
+        if len(attempts) == 1:
+            raise RateLimited(0.2)
+        done.set()
+
+    queue = JobQueue(runner, workers={"light": 1})
+    queue.start()
+    job = queue.submit(Job("command", {}, command="close"))
+    assert done.wait(5)
+    assert job.status == "deferred"
+    assert attempts[1] - attempts[0] >= 0.2
+    assert queue.drain(5)
+    assert queue.stats()["deferred"] == 1
+
+
+def test_identical_commands_are_coalesced():
+    ran = []
+
+    def runner(job):
+        ran.append((job.user, job.arguments))
+        job.refused = job.user == "stranger"
+
+    queue = JobQueue(runner, workers={"heavy": 1})
+    first = _pr_job("backport", "to v3.8.x", "stranger")
+    assert queue.submit(first) is first
+    assert queue.submit(_pr_job("backport", "to  v3.8.x ", "maintainer")) is first
+    assert queue.submit(_pr_job("backport", "to v3.7.x", "maintainer")) is not first
+    assert queue.submit(_pr_job("backport", "to v3.8.x", "other")) is first
+    assert queue.stats()["pending"] == 2
+    assert queue.stats()["coalesced"] == 2
+
+    queue.start()
+    deadline = time.time() + 5
+    while len(ran) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    assert queue.drain(5)
+    # the stranger was not allowed, the maintainer was and "other" got their result.
+    assert ran == [
+        ("stranger", "to v3.8.x"),
+        ("maintainer", "to v3.7.x"),
+        ("maintainer", "to  v3.8.x "),
+    ]
+
+
+def test_commands_are_known_by_one_name():
+    aliases = {"pre-commit": "precommit", "precommit": "precommit"}
+    queue = JobQueue(lambda job: None, workers={"heavy": 1}, aliases=aliases)
+    job = queue.submit(_pr_job("precommit", " --all  files"))
+    assert job.matches("org/repo", 1, "precommit", "--all files ")
+    assert queue.cancel("org/repo", 1, "pre-commit", "--all files") == [job]
+
+
+def test_comment_context_is_shared():
+    session = mock.Mock()
+    session.ghrequest.return_value.json.return_value = {"number": 1}
+    context = CommentContext()
+    assert context.get_session(lambda: session) is context.get_session(mock.Mock)
+    url = "https://api.github.com/repos/org/repo/pulls/1"
+    assert context.pull_request(session, url) == {"number": 1}
+    assert context.pull_request(session, url) == {"number": 1}
+    assert session.ghrequest.call_count == 1
+    context.forget_pull_requests()
+    context.pull_request(session, url)
+    assert session.ghrequest.call_count == 2
+
+    job = _pr_job("precommit", None)
+    job.context = context
+    assert job.renew().context is context
+    assert not context.reusable("repo")
+
+
+def _pr_job(command, arguments, user=None):
+    payload = {
+        "issue": {"number": 1},
+        "repository": {"name": "repo", "full_name": "org/repo", "owner": {"login": "org"}},
+    }
+    return Job("command", payload, user=user, command=command, arguments=arguments, lane="heavy")
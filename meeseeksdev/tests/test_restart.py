@@ -0,0 +1,66 @@
+import asyncio
+import os
+import signal
+import time
+from unittest import mock
+
+from tornado.ioloop import IOLoop
+
+from ..meeseeksbox import core
+from ..meeseeksbox.core import GENERATION, PREDECESSOR, Config, MeeseeksBox
+from ..meeseeksbox.jobs import Job
+
+
+def box():
+    config = Config(
+        integration_id=100,
+        botname="meeseeksdev",
+        key=None,
+        personal_account_token="foo",
+        personal_account_name="bar",
+        forward_staging_url="",
+        webhook_secret="foo",
+        reuse_port=True,
+        port=0,
+        drain_timeout=5,
+    )
+    return MeeseeksBox({}, config)
+
+
+def test_restarts_start_a_generation_stopping_the_current_one():
+    supervisor = box()
+    supervisor.generations = []
+    with mock.patch.object(core.subprocess, "Popen") as popen:
+        popen.return_value.pid = 1234
+        supervisor.spawn()
+        supervisor.restart_handler(signal.SIGHUP, None)
+        # the previous one is still draining.
+        supervisor.restart_handler(signal.SIGHUP, None)
+    envs = [call.kwargs["env"] for call in popen.call_args_list]
+    assert len(envs) == 2 and all(env[GENERATION] == "1" for env in envs)
+    assert PREDECESSOR not in envs[0] and envs[1][PREDECESSOR] == "1234"
+
+
+async def test_successor_stops_predecessor_once_ready_and_it_drains():
+    successor = box()
+    events: list = []
+    loop = type(IOLoop.current())
+    successor.auth._build_auth_id_mapping = lambda reuse: events.append("mapping")
+    with mock.patch.dict(os.environ, {GENERATION: "1", PREDECESSOR: "4321"}), mock.patch.object(
+        core.os, "kill", lambda pid, sig: events.append((pid, sig))
+    ), mock.patch.object(loop, "start"), mock.patch.object(loop, "stop") as stop:
+        successor.start()
+        assert events == ["mapping", (4321, signal.SIGTERM)]
+
+        # now in the shoes of the predecessor.
+        successor.dispatcher.jobs.runner = lambda job: time.sleep(0.5)
+        successor.dispatcher.jobs.submit(Job("reply", {}))
+        await asyncio.sleep(0.1)
+        successor.shutdown()
+        assert not stop.called
+        for _ in range(30):
+            if stop.called:
+                break
+            await asyncio.sleep(0.1)
+        assert stop.called and successor.dispatcher.jobs.running == 0
+        assert successor.dispatcher.jobs.stats()["done"] == 1
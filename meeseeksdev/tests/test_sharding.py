@@ -0,0 +1,93 @@
+import hmac
+import json
+
+import pytest
+import tornado.httpserver
+import tornado.testing
+import tornado.web
+
+from ..meeseeksbox.core import (
+    FORWARDED_BY,
+    Authenticator,
+    Config,
+    Dispatcher,
+    WebHookHandler,
+)
+from ..meeseeksbox.sharding import HashRing, Shards
+
+NODE_A = "http://node-a/webhook"
+
+
+def test_removing_a_node_only_moves_its_installations():
+    nodes = ["http://a", "http://b", "http://c"]
+    ring = HashRing(nodes)
+    owners = {i: ring.owner(str(i)) for i in range(1000)}
+    assert set(owners.values()) == set(nodes)
+    assert min(list(owners.values()).count(n) for n in nodes) > 200
+
+    smaller = HashRing(["http://a", "http://c"])
+    for i, owner in owners.items():
+        if owner != "http://b":
+            assert smaller.owner(str(i)) == owner
+
+
+def test_nodes_need_the_url_of_this_node():
+    with pytest.raises(ValueError):
+        Shards("", ["http://a", "http://b"])
+
+
+class Recorder(tornado.web.RequestHandler):
+    received: list = []
+
+    def post(self):
+        self.received.append(self.request.headers.get(FORWARDED_BY))
+        self.set_status(202)
+
+
+@pytest.fixture
+def node_b():
+    sock, port = tornado.testing.bind_unused_port()
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([(r"/webhook", Recorder)]))
+    server.add_sockets([sock])
+    yield server, f"http://127.0.0.1:{port}/webhook"
+    server.stop()
+
+
+@pytest.fixture
+def app(node_b):
+    config = Config(
+        integration_id=100,
+        botname="meeseeksdev",
+        key=None,
+        personal_account_token="foo",
+        personal_account_name="bar",
+        forward_staging_url="",
+        webhook_secret="foo",
+        node_url=NODE_A,
+        nodes=[NODE_A, node_b[1]],
+    )
+    auth = Authenticator(config.integration_id, config.key, "foo", "bar")
+    dispatcher = Dispatcher({}, config, auth)
+    return tornado.web.Application(
+        [(r"/", WebHookHandler, {"config": config, "dispatcher": dispatcher})]
+    )
+
+
+async def test_hooks_go_to_the_node_owning_the_installation(http_server_client, node_b):
+    server, url = node_b
+    shards = Shards(NODE_A, [NODE_A, url])
+    installation = next(i for i in range(1, 100) if shards.owner(i) == url)
+    body = json.dumps({"installation": {"id": installation}})
+    sig = "sha1=" + hmac.new(b"foo", body.encode("utf8"), "sha1").hexdigest()
+    headers = {"X-Hub-Signature": sig, "X-GitHub-Delivery": "sharded"}
+
+    response = await http_server_client.fetch("/", method="POST", body=body, headers=headers)
+    assert response.code == 202
+    assert Recorder.received == [NODE_A]
+
+    # node b is gone, node a takes over.
+    server.stop()
+    await server.close_all_connections()
+    response = await http_server_client.fetch("/", method="POST", body=body, headers=headers)
+    assert response.code == 200
+    assert Recorder.received == [NODE_A]
@@ -0,0 +1,166 @@
+import os
+import time
+
+from ..meeseeksbox.jobs import Job, JobQueue
+from ..meeseeksbox.store import DeliveryIndex, JobStore
+
+
+def test_unfinished_jobs_are_resumed_with_their_phases():
+    store = JobStore(":memory:")
+    job = Job("command", {"repository": {"full_name": "org/repo"}}, command="backport")
+    store.add(job)
+    job.status = "running"
+    job._store = store
+    job.checkpoint("fork")
+    job.checkpoint("clone", workspace="/tmp/repo")
+
+    done = Job("command", {}, command="zen")
+    done.status = "done"
+    store.add(done)
+
+    (resumed,) = store.unfinished()
+    assert resumed.id == job.id
+    assert resumed.phases == ["fork", "clone"]
+    assert resumed.workspace == "/tmp/repo"
+    assert resumed.repo == "org/repo"
+
+    queue = JobQueue(lambda job: None, store=store)
+    queue.resume()
+    assert queue.stats()["pending"] == 1
+
+
+def test_old_jobs_are_abandoned():
+    store = JobStore(":memory:")
+    job = Job("command", {}, command="backport")
+    job.queued_at = time.time() - 2 * 24 * 3600
+    store.add(job)
+    queue = JobQueue(lambda job: None, store=store)
+    queue.resume()
+    assert queue.stats()["pending"] == 0
+    assert store.unfinished() == []
+
+
+def test_closed_queue_drains():
+    queue = JobQueue(lambda job: time.sleep(0.1))
+    queue.start()
+    queue.submit(Job("command", {}, command="hello"))
+    time.sleep(0.05)
+    queue.close()
+    assert queue.drain(5)
+    assert queue.running == 0
+
+
+def test_delivery_index_is_bounded_and_persisted():
+    deliveries = DeliveryIndex(2)
+    assert not deliveries.seen("a")
+    assert not deliveries.seen("b")
+    assert deliveries.seen("a")
+    assert not deliveries.seen("c")
+    # "b" was the least recently seen.
+    assert not deliveries.seen("b")
+    assert not deliveries.seen(None)
+    assert deliveries.duplicates == 1
+
+    store = JobStore(":memory:")
+    deliveries = DeliveryIndex(2, store=store)
+    for delivery in "abc":
+        assert not deliveries.seen(delivery)
+    # forgotten by the index, not by the store.
+    assert deliveries.seen("a")
+    deliveries.forget("b")
+    restarted = DeliveryIndex(2, store=store)
+    assert restarted.seen("c")
+    assert not restarted.seen("b")
+
+
+def test_processes_share_jobs_and_cache(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    first, second = JobStore(path), JobStore(path)
+    job = Job("command", {}, command="backport", lane="heavy")
+    job.queued_at -= 60
+    first.add(job)
+
+    queue = JobQueue(lambda job: None, workers={"heavy": 1}, store=second, steal_after=30)
+    stolen = queue._next("heavy")
+    assert stolen is not None and stolen.id == job.id
+    # the process that queued it cannot run it anymore.
+    assert not first.claim(job, "someone else")
+
+    first.cache_set("token:1", "secret", 60)
+    assert second.cache_get("token:1") == "secret"
+    first.cache_set("token:2", "expired", -1)
+    assert second.cache_get("token:2") is None
+
+
+def test_released_jobs_are_taken_over(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    old = JobQueue(lambda job: None, workers={"heavy": 1}, store=JobStore(path))
+    job = Job("command", {}, command="backport", lane="heavy")
+    job.queued_at -= 60
+    old.submit(job)
+    assert old._next("heavy") is job
+    job.checkpoint("clone", "/tmp/checkout")
+    assert old.release() == [job]
+
+    new = JobQueue(lambda job: None, workers={"heavy": 1}, store=JobStore(path), steal_after=30)
+    resumed = new._next("heavy")
+    assert resumed is not None and resumed.id == job.id
+    assert resumed.done("clone")
+
+
+def test_jobs_of_live_processes_are_not_resumed(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    store = JobStore(path)
+    sibling = JobQueue(lambda job: None, workers={"heavy": 1}, store=store)
+    sibling.owner = f"{os.uname().nodename}:{os.getppid()}"
+    running = sibling.submit(Job("command", {}, command="backport", lane="heavy"))
+    assert sibling._next("heavy") is running
+    crashed = Job("command", {}, command="backport", lane="heavy")
+    store.add(crashed)
+    store.claim(crashed, f"{os.uname().nodename}:999999999")
+
+    # a respawned process resumes the job of the one that crashed only.
+    respawned = JobQueue(lambda job: None, workers={"heavy": 1}, store=JobStore(path))
+    respawned.resume()
+    assert [job.id for job in respawned._pending["heavy"]] == [crashed.id]
+
+
+def test_other_processes_cancel_supersede_and_coalesce(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+
+    def runner(job):
+        job.head = "old"
+        if job.command == "backport":
+            job.authorize()
+        while True:
+            time.sleep(0.01)
+            job.token.check()
+
+    payload = {"repository": {"full_name": "org/repo"}, "issue": {"number": 1}}
+    owner = JobQueue(runner, workers={"heavy": 2}, store=JobStore(path), steal_after=30)
+    other = JobQueue(runner, workers={"heavy": 1}, store=JobStore(path), steal_after=30)
+    owner.poll_interval = other.poll_interval = 0.05
+    owner.start()
+    backport = owner.submit(Job("command", payload, command="backport", lane="heavy"))
+    black = owner.submit(Job("command", payload, command="black", lane="heavy"))
+    for _ in range(100):
+        if owner.running == 2 and black.head:
+            break
+        time.sleep(0.01)
+
+    again = Job("command", payload, command="backport", lane="heavy")
+    assert other.submit(again).id == backport.id
+    assert other.stats()["coalesced"] == 1 and other.stats()["pending"] == 0
+    # its requester may yet be refused, and this one would get no answer.
+    unchecked = Job("command", payload, command="black", lane="heavy")
+    assert other.submit(unchecked) is unchecked
+    assert other.stats()["coalesced"] == 1 and other.stats()["pending"] == 1
+
+    assert [job.id for job in other.cancel("org/repo", 1, "backport")] == [backport.id]
+    assert [job.id for job in other.supersede("org/repo", 1, "new", {"black"})] == [black.id]
+    for _ in range(100):
+        if owner.stats()["cancelled"] == 1 and owner.stats()["superseded"] == 1:
+            break
+        time.sleep(0.01)
+    assert owner.stats()["cancelled"] == 1 and owner.stats()["superseded"] == 1
+    owner.close()
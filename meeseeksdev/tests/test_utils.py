@@ -0,0 +1,235 @@
+import asyncio
+import json
+import time
+from unittest import mock
+
+import pytest
+import requests
+import tornado.web
+from requests.structures import CaseInsensitiveDict
+
+from ..meeseeksbox.utils import (
+    Authenticator,
+    DeadlineExceeded,
+    RateBudgets,
+    RateLimited,
+    ResponseCache,
+    _retry_delay,
+    responses,
+    set_deadline,
+    set_low_priority,
+    transports,
+)
+
+
+def access_token(token, expires_in):
+    expires_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + expires_in))
+    response = mock.Mock(status_code=201)
+    response.content = json.dumps({"token": token, "expires_at": expires_at}).encode()
+    return response
+
+
+def test_installation_tokens_are_shared_and_refreshed_ahead():
+    auth = Authenticator(100, None, "foo", "bar")
+    requests = mock.Mock(side_effect=[access_token("first", 3600), access_token("second", 3600)])
+    with mock.patch.object(Authenticator, "_integration_authenticated_request", requests):
+        assert auth.session("1").token() == "first"
+        assert auth.session("1").token() == "first"
+        assert requests.call_count == 1
+
+        # about to expire, still used while a new one is fetched.
+        auth.tokens.set("1", "first", time.time() + 120)
+        assert auth.session("1").token() == "first"
+        for _ in range(50):
+            if auth.session("1").token() == "second":
+                break
+            time.sleep(0.01)
+        assert requests.call_count == 2
+        assert auth.session("1").token() == "second"
+
+
+class Label(tornado.web.RequestHandler):
+    def get(self, name):
+        assert self.request.headers["Authorization"] == "Bearer secret"
+        self.write({"name": name})
+
+    def post(self, name):
+        self.set_status(201)
+        self.write(json.loads(self.request.body))
+
+
+class Flaky(tornado.web.RequestHandler):
+    calls = 0
+
+    def get(self):
+        Flaky.calls += 1
+        if Flaky.calls == 1:
+            self.set_status(502)
+        self.write({"calls": Flaky.calls})
+
+    def post(self):
+        self.set_status(502)
+
+
+class Pages(tornado.web.RequestHandler):
+    # the Host header is GitHub's, not ours.
+    url = ""
+    requested: list = []
+
+    def get(self):
+        page = int(self.get_argument("page", "1"))
+        self.requested.append((page, self.get_argument("per_page")))
+        if page < 3:
+            next_url = f"{self.url}?per_page=100&page={page + 1}"
+            self.set_header("Link", f'<{next_url}>; rel="next"')
+        self.write(json.dumps([{"page": page, "item": i} for i in range(2)]))
+
+
+@pytest.fixture
+def app():
+    return tornado.web.Application(
+        [(r"/labels/(.*)", Label), (r"/flaky", Flaky), (r"/pages", Pages)]
+    )
+
+
+async def test_async_session_makes_calls_concurrently(http_server_client):
+    auth = Authenticator(100, None, "foo", "bar")
+    auth.tokens.set("1", "secret", time.time() + 3600)
+    session = auth.async_session("1")
+    urls = [http_server_client.get_url(f"/labels/{name}") for name in ("bug", "backport")]
+
+    responses = await asyncio.gather(*(session.ghrequest("GET", url) for url in urls))
+    assert [r.json()["name"] for r in responses] == ["bug", "backport"]
+    response = await session.ghrequest("POST", urls[0], json={"description": "on-merge:"})
+    assert response.status_code == 201 and response.json() == {"description": "on-merge:"}
+
+
+async def test_unmodified_responses_are_served_from_cache(http_server_client):
+    auth = Authenticator(100, None, "foo", "bar")
+    auth.tokens.set("1", "secret", time.time() + 3600)
+    session = auth.async_session("1")
+    url = http_server_client.get_url("/labels/bug")
+    hits = responses.hits
+
+    first = await session.ghrequest("GET", url)
+    second = await session.ghrequest("GET", url)
+    assert responses.hits == hits + 1
+    assert second.status_code == 200 and second.json() == first.json() == {"name": "bug"}
+
+
+def cache_response(status, body=b"", **headers):
+    response = requests.Response()
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = body
+    return response
+
+
+def test_not_modified_is_served_even_if_evicted_meanwhile():
+    cache = ResponseCache(size=1)
+    cache.revalidated("a", cache_response(200, b'{"name": "bug"}', ETag='"1"'))
+    cached = cache.get("a")
+    assert cache.validators(cached) == {"If-None-Match": '"1"'}
+
+    cache.revalidated("b", cache_response(200, b"{}", ETag='"2"'))
+    assert cache.get("a") is None
+    response = cache.revalidated(
+        "a", cache_response(304, **{"X-RateLimit-Remaining": "10"}), cached
+    )
+    assert response.json() == {"name": "bug"}
+    assert response.headers["X-RateLimit-Remaining"] == "10"
+    assert cache.get("a") is cached
+
+
+def rate_response(status, remaining, reset_in, **headers):
+    response = mock.Mock(status_code=status, text="")
+    response.headers = {
+        "X-RateLimit-Limit": "5000",
+        "X-RateLimit-Remaining": str(remaining),
+        "X-RateLimit-Reset": str(int(time.time() + reset_in)),
+        **headers,
+    }
+    return response
+
+
+def test_low_priority_work_is_deferred_when_budget_runs_low():
+    budgets = RateBudgets(reserve=0.2, defer_after=30)
+    budgets.record("installation:1", "GET", rate_response(200, 900, 600))
+    assert budgets.stats()["installation:1"]["remaining"] == 900
+    assert budgets.delay("installation:1", "GET") == 0
+    set_low_priority(True)
+    try:
+        with pytest.raises(RateLimited) as e:
+            budgets.delay("installation:1", "GET")
+        assert 590 < e.value.delay <= 600
+    finally:
+        set_low_priority(False)
+
+    # secondary limit, everyone waits.
+    budgets.record("installation:1", "POST", rate_response(403, 800, 600, **{"Retry-After": "5"}))
+    assert 4 < budgets.delay("installation:1", "POST") <= 5
+    assert budgets.stats()["installation:1"]["content_last_minute"] == 1
+    # GraphQL queries do not create content.
+    budgets.record("installation:1", "POST", rate_response(200, 799, 600), endpoint="read")
+    assert budgets.stats()["installation:1"]["content_last_minute"] == 1
+
+
+async def test_idempotent_requests_are_retried_within_deadline(http_server_client):
+    auth = Authenticator(100, None, "foo", "bar")
+    auth.tokens.set("2", "secret", time.time() + 3600)
+    session = auth.async_session("2")
+    url = http_server_client.get_url("/flaky")
+
+    response = await session.ghrequest("GET", url)
+    assert response.json() == {"calls": 2}
+    assert transports.stats()["installation:2"]["retries"] == 1
+    # not safe to send twice.
+    response = await session._send("POST", url, {}, "application/json", {})
+    assert response.status_code == 502
+    assert transports.stats()["installation:2"]["retries"] == 1
+    # unless it only reads, like GraphQL queries.
+    assert _retry_delay("POST", 0, endpoint="read") is not None
+
+    set_deadline(time.time() - 1)
+    try:
+        with pytest.raises(DeadlineExceeded):
+            await session.ghrequest("GET", url)
+    finally:
+        set_deadline(None)
+
+
+async def test_pages_are_fetched_as_items_are_consumed(http_server_client):
+    auth = Authenticator(100, None, "foo", "bar")
+    auth.tokens.set("1", "secret", time.time() + 3600)
+    session = auth.session("1")
+    url = Pages.url = http_server_client.get_url("/pages")
+    loop = asyncio.get_running_loop()
+
+    first = await loop.run_in_executor(None, next, session.paginate(url))
+    assert first == {"page": 1, "item": 0}
+    assert Pages.requested == [(1, "100")]
+
+    hits = responses.hits
+    items = await loop.run_in_executor(None, list, session.paginate(url))
+    assert [(i["page"], i["item"]) for i in items] == [(p, i) for p in (1, 2, 3) for i in (0, 1)]
+    assert Pages.requested == [(1, "100"), (1, "100"), (2, "100"), (3, "100")]
+    # the first page had not changed.
+    assert responses.hits == hits + 1
+
+    pages = auth.async_session("1").paginate(url)
+    assert [(i["page"], i["item"]) async for i in pages] == [(i["page"], i["item"]) for i in items]
+
+
+def test_installations_index_their_repositories():
+    auth = Authenticator(100, None, "foo", "bar")
+    auth._map_repository("org/a", "1")
+    auth._map_repository("org/b", "1")
+    auth._map_repository("other/c", "2")
+    session = auth.session("1")
+    assert session.repositories("1") == {"org/a", "org/b"}
+
+    # moved to another installation, seen by existing sessions.
+    auth._map_repository("org/b", "2")
+    assert session.repositories("1") == {"org/a"}
+    assert session.repositories("2") == {"org/b", "other/c"}
+    assert session.idmap["org/b"] == "2" and session._org_idmap["other"] == "2"
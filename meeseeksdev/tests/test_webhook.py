@@ -1,14 +1,28 @@
+import asyncio
 import hmac
+import json
+from unittest import mock
 
 import pytest
 import tornado.web
 
-from ..meeseeksbox.core import Authenticator, Config, WebHookHandler
+from ..meeseeksbox.commands import black_suggest, blackify, replyuser, safe_backport
+from ..meeseeksbox.core import (
+    Authenticator,
+    Config,
+    Dispatcher,
+    WebHookHandler,
+    canonical_names,
+)
+from ..meeseeksbox.jobs import Job
+from ..meeseeksbox.scopes import Permission, everyone, write
+from ..meeseeksbox.utils import AsyncSession
 
-commands: dict = {}
+commands: dict = {"hello": replyuser}
 
 config = Config(
     integration_id=100,
+    botname="meeseeksdev",
     key=None,
     personal_account_token="foo",
     personal_account_name="bar",
@@ -23,15 +37,16 @@ auth = Authenticator(
     config.personal_account_name,
 )
 
+dispatcher = Dispatcher(commands, config, auth)
+
 application = tornado.web.Application(
     [
         (
             r"/",
             WebHookHandler,
             {
-                "actions": commands,
                 "config": config,
-                "auth": auth,
+                "dispatcher": dispatcher,
             },
         ),
     ]
@@ -56,3 +71,134 @@ async def test_post(http_server_client):
     headers = {"X-Hub-Signature": sig}
     response = await http_server_client.fetch("/", method="POST", body=body, headers=headers)
     assert response.code == 200
+
+
+async def test_post_mention_is_queued(http_server_client):
+    payload = {
+        "action": "created",
+        "repository": {"full_name": "org/repo", "name": "repo", "owner": {"login": "org"}},
+        "issue": {"number": 1},
+        "comment": {"user": {"login": "someone"}, "body": "@meeseeksdev hello"},
+    }
+    body = json.dumps(payload)
+    secret = config.webhook_secret
+    assert secret is not None
+    sig = "sha1=" + hmac.new(secret.encode("utf8"), body.encode("utf8"), "sha1").hexdigest()
+    headers = {"X-Hub-Signature": sig, "X-GitHub-Delivery": "abc"}
+    response = await http_server_client.fetch("/", method="POST", body=body, headers=headers)
+    assert response.code == 202
+    assert dispatcher.jobs.stats()["pending"] == 1
+
+
+async def test_redelivery_is_ignored(http_server_client):
+    payload = {
+        "action": "created",
+        "repository": {"full_name": "org/repo", "name": "repo", "owner": {"login": "org"}},
+        "issue": {"number": 2},
+        "comment": {"user": {"login": "someone"}, "body": "@meeseeksdev hello"},
+    }
+    body = json.dumps(payload)
+    secret = config.webhook_secret
+    assert secret is not None
+    sig = "sha1=" + hmac.new(secret.encode("utf8"), body.encode("utf8"), "sha1").hexdigest()
+    headers = {"X-Hub-Signature": sig, "X-GitHub-Delivery": "redelivered"}
+    response = await http_server_client.fetch("/", method="POST", body=body, headers=headers)
+    assert response.code == 202
+    pending = dispatcher.jobs.stats()["pending"]
+    response = await http_server_client.fetch("/", method="POST", body=body, headers=headers)
+    assert response.code == 200
+    assert dispatcher.jobs.stats()["pending"] == pending
+    assert dispatcher.deliveries.duplicates == 1
+
+
+async def test_delivery_failing_to_be_handled_can_be_redelivered(http_server_client):
+    payload = {
+        "action": "created",
+        "repository": {"full_name": "org/repo", "name": "repo", "owner": {"login": "org"}},
+        "issue": {"number": 3},
+        "comment": {"user": {"login": "someone"}, "body": "@meeseeksdev hello"},
+    }
+    body = json.dumps(payload)
+    secret = config.webhook_secret
+    assert secret is not None
+    sig = "sha1=" + hmac.new(secret.encode("utf8"), body.encode("utf8"), "sha1").hexdigest()
+    headers = {"X-Hub-Signature": sig, "X-GitHub-Delivery": "failed"}
+    with mock.patch.object(WebHookHandler, "dispatch_action", side_effect=RuntimeError):
+        response = await http_server_client.fetch(
+            "/", method="POST", body=body, headers=headers, raise_error=False
+        )
+    assert response.code == 500
+    response = await http_server_client.fetch("/", method="POST", body=body, headers=headers)
+    assert response.code == 202
+
+
+def test_commands_only_look_up_what_their_scope_needs():
+    ran = []
+
+    @everyone
+    def ping(*, session, payload, arguments, local_config=None):
+        ran.append("ping")
+
+    @write
+    def fix(*, session, payload, arguments, local_config=None):
+        ran.append("fix")
+
+    session = mock.Mock()
+    session.ghrequest.side_effect = RuntimeError("no GraphQL")
+    session._get_permission.return_value = Permission.admin
+    auth = mock.Mock()
+    auth.session.return_value = session
+    commands = Dispatcher({"ping": ping, "fix": fix}, config, auth)
+    payload = {
+        "installation": {"id": 1},
+        "repository": {"full_name": "org/repo", "name": "repo", "owner": {"login": "org"}},
+        "issue": {"number": 2, "pull_request": {"url": "pull"}, "user": {"login": "someone"}},
+    }
+
+    commands.run_command(Job("command", payload, user="someone", command="ping"))
+    assert ran == ["ping"]
+    assert session.ghrequest.call_count == 0
+    assert commands.skipped_lookups == {"permission": 1, "pull_request": 1, "config": 1}
+
+    commands.run_command(Job("command", payload, user="someone", command="fix"))
+    assert ran == ["ping", "fix"]
+    session._get_permission.assert_called_once_with("org", "repo", "someone")
+    assert commands.skipped_lookups == {"permission": 1, "pull_request": 2, "config": 2}
+
+
+def test_aliases_of_a_command_have_one_name():
+    actions = {
+        "black": blackify,
+        "blackify": blackify,
+        "reformat": blackify,
+        "backport": safe_backport,
+        "safe_backport": safe_backport,
+        "suggestions": black_suggest,
+    }
+    assert canonical_names(actions) == {
+        "black": "blackify",
+        "blackify": "blackify",
+        "reformat": "blackify",
+        "backport": "safe_backport",
+        "safe_backport": "safe_backport",
+        "suggestions": "suggestions",
+    }
+
+
+def test_coroutine_commands_are_awaited():
+    ran = []
+
+    @everyone
+    async def ping(*, session, payload, arguments, local_config=None):
+        await asyncio.sleep(0)
+        ran.append(type(session))
+
+    auth = mock.Mock()
+    commands = Dispatcher({"ping": ping}, config, auth)
+    payload = {
+        "installation": {"id": 1},
+        "repository": {"full_name": "org/repo", "name": "repo", "owner": {"login": "org"}},
+        "issue": {"number": 2, "user": {"login": "someone"}},
+    }
+    commands.run_command(Job("command", payload, user="someone", command="ping"))
+    assert ran == [AsyncSession]
@@ -0,0 +1,99 @@
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from ..meeseeksbox.jobs import Job, JobQueue
+from ..meeseeksbox.store import JobStore
+from ..meeseeksbox.utils import Cancelled, budgets, responses, transports
+from ..meeseeksbox.workers import WorkerPool
+
+
+def runner(job):
+    job.head = "abc123"
+    job.checkpoint("clone", os.getcwd())
+    if job.command == "slow":
+        while True:
+            time.sleep(0.05)
+            job.token.check()
+
+
+def test_jobs_run_in_recycled_workers():
+    pool = WorkerPool(runner, ":memory:", max_jobs=2)
+    job = Job("command", {}, command="backport", lane="heavy")
+    pool.run(job)
+    assert job.phases == ["clone"] and job.head == "abc123"
+
+    pids = [pool.stats()["workers"][0]["pid"]]
+    pool.run(Job("command", {}, command="backport", lane="heavy"))
+    assert pool.stats() == {"workers": [], "retired": 1}
+
+    pool.run(Job("command", {}, command="backport", lane="heavy"))
+    pids.append(pool.stats()["workers"][0]["pid"])
+    assert pids[0] != pids[1] and os.getpid() not in pids
+
+
+def test_cancelled_job_stops_in_worker():
+    pool = WorkerPool(runner, ":memory:")
+    job = Job("command", {}, command="slow", lane="heavy")
+    threading.Timer(0.5, job.token.cancel).start()
+    with pytest.raises(Cancelled):
+        pool.run(job)
+    # the head was known before the end of the job, to supersede it.
+    assert job.head == "abc123"
+    assert pool.stats()["workers"][0]["jobs"] == 1
+
+
+def test_released_jobs_keep_the_progress_made_in_workers(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    store = JobStore(path)
+    pool = WorkerPool(runner, path)
+    queue = JobQueue(pool.run, workers={"heavy": 1}, store=store)
+    queue.start()
+    job = queue.submit(Job("command", {}, command="slow", lane="heavy"))
+    deadline = time.time() + 10
+    while job.phases != ["clone"] and time.time() < deadline:
+        time.sleep(0.05)
+    assert job.phases == ["clone"]
+
+    # sent to every process of a dyno being restarted.
+    busy = pool.stats()["workers"][0]["pid"]
+    os.kill(busy, signal.SIGTERM)
+    time.sleep(0.5)
+    assert queue.running == 1 and pool.stats()["workers"][0]["pid"] == busy
+
+    queue.close()
+    assert not queue.drain(0.5)
+    queue.release()
+    pool.stop()
+    assert queue.drain(10)
+    [resumable] = store.unfinished()
+    assert (resumable.id, resumable.status, resumable.phases) == (job.id, "queued", ["clone"])
+
+
+def limited(job):
+    budgets.delay("installation:7", "GET")
+    responses.get(("7", "url"))
+    transports.retried("installation:7", "GET", 1, 0.5)
+
+
+def test_workers_do_not_inherit_held_locks_and_report_back():
+    def report():
+        return {"retries": transports.report()}
+
+    def merge(report):
+        transports.merge(report["retries"])
+
+    pool = WorkerPool(limited, ":memory:", report=report, merge=merge)
+    # other threads may be using them while the worker is forked.
+    with budgets._lock, responses._lock:
+        worker = threading.Thread(
+            target=pool.run, args=(Job("command", {}, lane="heavy"),), daemon=True
+        )
+        worker.start()
+        time.sleep(0.5)
+    worker.join(10)
+    assert not worker.is_alive()
+    assert transports.stats()["installation:7"]["retries"] == 1